@@ -1,6 +1,579 @@
+import atexit
+import functools
+import os
+import posixpath
+import re
+import shlex
+import shutil
 import subprocess
+import sys
+import threading
 import warnings
 
+try:
+	import pygit2
+except ImportError:  # optional, only used by the pygit2 backend
+	pygit2 = None
+
+_SHORT = {"q", "d", "P", "m", "b"}
+"""Options that are passed with a single dash."""
+
+_FLAGS = frozenset({"q", "d", "squash", "ignore-joins", "rejoin"})
+"""Options that are switched on by any true value and take no value."""
+_VALUED = frozenset({"P", "m", "annotate", "b", "onto"})
+"""Options passed with their value, as the following argument."""
+
+_SPLIT_OPTIONS = (
+	("annotate", "annotate"),
+	("b", "branch"),
+	("ignore-joins", "ignore_joins"),
+	("onto", "onto"),
+	("rejoin", "rejoin"),
+	("squash", "squash"),
+	("m", "message")
+)
+_OPT_TEMPLATES = {
+	"add": ((("squash", "squash"), ("m", "message")), ("local_commit", "repository", "remote_ref")),
+	"merge": ((("squash", "squash"), ("m", "message")), ("local_commit", "repository")),
+	"split": (_SPLIT_OPTIONS, ("local_commit", "repository")),
+	"pull": ((("squash", "squash"), ("m", "message")), ("repository", "remote_ref")),
+	"push": (_SPLIT_OPTIONS, ("repository", "refspec"))
+}
+"""Per command, the (option, parameter) pairs and the parameters passed as arguments, in order."""
+
+_OBJECT_ID = re.compile(r"[0-9a-f]{40}|[0-9a-f]{64}")
+"""A full SHA-1 or SHA-256 object ID."""
+
+_BUFFER_SIZE = 1 << 16
+"""Size of the pipe buffers and reads used to collect command output."""
+
+_GIT = os.environ.get("GIT_BINARY", "git")
+"""The git executable, overridable with the GIT_BINARY environment variable."""
+
+_SHELL = shutil.which("sh")
+"""The shell used by the helper processes, None if there is none, e.g. on Windows."""
+
+
+@functools.lru_cache(maxsize=None)
+def _switch(option: str) -> str:
+	"""The command line switch for `option`, formatted once per option name."""
+	return f"-{option}" if option in _SHORT else f"--{option}"
+
+
+@functools.lru_cache(maxsize=None)
+def _which(command: str):
+	"""Resolve `command` to its absolute path once, so it isn't looked up on every spawn."""
+	return shutil.which(command)
+
+
+def _environment() -> dict:
+	"""The environment for git processes: ours, as it is now."""
+	return dict(os.environ)
+
+
+@functools.lru_cache(maxsize=None)
+def _executor(max_workers: int):
+	"""The thread pool of the given size used by `GitSubtree.map`, created once and kept for reuse."""
+	import concurrent.futures
+
+	return concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="git-subtree")
+
+
+class _Helper:
+	"""
+	A long-lived `sh` process that executes one command line per request.
+
+	`git subtree` can't be driven in batch mode, so instead of forking the
+	(potentially large) python process for every command, commands are
+	written to this shell, which forks the much smaller shell instead.
+	Each command's stdout is terminated by a sentinel carrying its exit
+	status. The shell and its commands keep the `environment` it was
+	started with.
+	"""
+
+	def __init__(self, environment: dict):
+		self.environment = environment
+		self.sentinel = f"__END_{os.urandom(16).hex()}__".encode()
+		self.process = subprocess.Popen(
+			[
+				_SHELL, "-c",
+				"unset CDPATH\n"
+				"nl='\n'\n"
+				"while IFS= read -r line; do\n"
+				"\teval \"$line\" </dev/null\n"
+				f"\tprintf '\\n%s %d\\n' {self.sentinel.decode()} \"$?\"\n"
+				"done"
+			],
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.DEVNULL,
+			bufsize=_BUFFER_SIZE,
+			env=environment,
+			close_fds=False  # together with the absolute executable path, lets python use posix_spawn
+		)
+
+	@staticmethod
+	def quote(argument: str) -> str:
+		"""Quote `argument` for the shell, keeping the command line on a single line."""
+		return shlex.quote(argument).replace("\n", "'\"$nl\"'")
+
+	@classmethod
+	def command_line(cls, args, capture: bool = True) -> str:
+		"""Quote `args` as a command line, discarding its stdout unless `capture`."""
+		return " ".join(map(cls.quote, args)) + ("" if capture else " >/dev/null")
+
+	def send(self, command_line: str, cwd: str):
+		"""
+		Start `command_line` in `cwd`, to be followed by `receive`.
+		A relative `cwd` is relative to our working directory, not to that
+		of the previous command, which the shell is still in.
+		"""
+		line = f"cd {self.quote(os.path.abspath(cwd))} && {command_line}\n".encode()
+		self.process.stdin.write(line)
+		self.process.stdin.flush()
+
+	def receive(self) -> tuple:
+		"""Wait for the command started by `send` and return its exit status and stdout."""
+		terminator = b"\n" + self.sentinel + b" "
+		output = bytearray()
+		end = -1
+		while True:
+			chunk = self.process.stdout.read1(_BUFFER_SIZE)
+			if not chunk:
+				raise BrokenPipeError("The git-subtree helper process exited unexpectedly.")
+			searched = len(output)
+			output += chunk
+			if end == -1:
+				end = output.find(terminator, max(0, searched - len(terminator)))
+			if end != -1:
+				status_end = output.find(b"\n", end + len(terminator))
+				if status_end != -1:
+					return int(output[end + len(terminator):status_end]), bytes(output[:end])
+
+	def close(self):
+		"""Let the shell exit by closing its stdin, wait for it and close its stdout."""
+		try:
+			self.process.stdin.close()
+		except BrokenPipeError:  # it exited, with a request left unwritten
+			pass
+		self.process.wait()
+		self.process.stdout.close()
+
+
+class _WorkerPool:
+	"""
+	Helper shells shared by all `GitSubtree` instances, so that a shell is
+	started at most `size` times per process instead of once per instance.
+	Shells are started on demand and each runs one command at a time.
+	"""
+
+	def __init__(self, size: int):
+		self.size = size
+		self.workers = []
+		self.idle = []
+		self.condition = threading.Condition()
+
+	def run(self, command_line: str, cwd: str) -> tuple:
+		"""
+		Run `command_line` in `cwd` on an idle worker and return its exit
+		status and stdout. If the worker turns out to have exited before
+		the command could be written to it, the command is retried once on
+		another one.
+		"""
+		environment = _environment()
+		for attempt in range(2):
+			worker = self.acquire(environment)
+			try:
+				worker.send(command_line, cwd)
+			except BrokenPipeError:
+				self.discard(worker)
+				if attempt:
+					raise
+				continue
+			except BaseException:
+				self.discard(worker)
+				raise
+			break
+		try:
+			result = worker.receive()
+		except BaseException:
+			self.discard(worker)
+			raise
+		self.release(worker)
+		return result
+
+	def acquire(self, environment: dict) -> _Helper:
+		"""
+		Take an idle worker running with `environment`, starting a new one if
+		there is room in the pool. Idle workers that exited, e.g. killed by a
+		Ctrl-C sent to our process group, are dropped, and so are those
+		started with an environment that has changed since.
+		"""
+		stale = []
+		with self.condition:
+			worker = None
+			while worker is None:
+				while self.idle and worker is None:
+					worker = self.idle.pop()
+					if worker.process.poll() is not None or worker.environment != environment:
+						self.workers.remove(worker)
+						stale.append(worker)
+						worker = None
+				if worker is None:
+					if len(self.workers) < self.size:
+						worker = _Helper(environment)
+						self.workers.append(worker)
+					else:
+						self.condition.wait()
+		for old in stale:
+			old.close()
+		return worker
+
+	def release(self, worker: _Helper):
+		"""Return `worker` to the pool, unless the pool was shut down in the meantime."""
+		with self.condition:
+			if worker in self.workers:
+				self.idle.append(worker)
+				self.condition.notify()
+				return
+		worker.close()
+
+	def discard(self, worker: _Helper):
+		"""Remove a broken `worker` from the pool."""
+		with self.condition:
+			if worker in self.workers:
+				self.workers.remove(worker)
+				self.condition.notify()
+		worker.close()
+
+	def shutdown(self):
+		"""Terminate all idle workers; busy ones exit once their command is done."""
+		with self.condition:
+			idle = self.idle
+			self.workers, self.idle = [], []
+			self.condition.notify_all()
+		for worker in idle:
+			worker.close()
+
+
+_POOL = _WorkerPool(os.cpu_count() or 1)
+atexit.register(_POOL.shutdown)
+
+_PROC_CACHE = {}
+"""Per repository, a `git cat-file --batch-check` process and the lock serializing its queries."""
+_PROC_CACHE_LOCK = threading.Lock()
+
+
+def _forget_processes():
+	"""
+	After a fork, let the child start processes of its own instead of
+	writing to those of the parent, which the parent keeps using. Only the
+	child's copies of their pipes are closed, without flushing them, so
+	that the parent's processes still see end of file once the parent
+	closes them. The locks are replaced, since a thread of the parent may
+	have held them.
+	"""
+	global _PROC_CACHE_LOCK
+	processes = [worker.process for worker in _POOL.workers] + [process for process, _ in _PROC_CACHE.values()]
+	_POOL.workers, _POOL.idle = [], []
+	_POOL.condition = threading.Condition()
+	_PROC_CACHE.clear()
+	_PROC_CACHE_LOCK = threading.Lock()
+	for process in processes:
+		process.stdin.raw.close()
+		process.stdout.raw.close()
+		process.poll()  # not our child, so this only marks it as none of our business
+
+
+if hasattr(os, "register_at_fork"):  # not on Windows
+	os.register_at_fork(after_in_child=_forget_processes)
+
+
+def _batch_check(repository_path: str, object_name: str) -> str:
+	"""
+	Look up `object_name` with the long-lived `git cat-file --batch-check`
+	process of the repository, started on first use.
+
+	:return: The type of the object, or None if it doesn't exist.
+	"""
+	repository_path = os.path.realpath(repository_path)
+	with _PROC_CACHE_LOCK:
+		if repository_path not in _PROC_CACHE or _PROC_CACHE[repository_path][0].poll() is not None:
+			_PROC_CACHE[repository_path] = subprocess.Popen(
+				[_which(_GIT), "-C", repository_path, "cat-file", "--batch-check"],
+				stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE,
+				stderr=subprocess.DEVNULL,
+				close_fds=False,
+				env={**_environment(), "GIT_OPTIONAL_LOCKS": "0"}  # purely a reader, never refresh the index
+			), threading.Lock()
+		process, lock = _PROC_CACHE[repository_path]
+	with lock:
+		process.stdin.write(object_name.encode() + b"\n")
+		process.stdin.flush()
+		response = process.stdout.readline().split()
+	return response[1].decode() if len(response) == 3 else None  # "<object> missing" otherwise
+
+
+_SPLIT_CACHE = {}
+"""Per cache file, the commit IDs of earlier splits by their inputs, oldest first."""
+_SPLIT_CACHE_LINES = {}
+"""Per cache file, the number of lines in it."""
+_SPLIT_CACHE_LOCK = threading.Lock()
+
+_SPLIT_CACHE_SIZE = 1024
+"""The number of split results kept per repository. Their file is compacted to those once it has twice as many lines."""
+
+
+def _split_cache(path: str) -> dict:
+	"""
+	The split results stored at `path`, read on first use. Only use it while holding the lock.
+
+	The file has a JSON [key, commit ID] pair per line, appended as splits
+	are stored, where a later line replaces an earlier one with the same
+	key, and a commit ID of null removes it.
+	"""
+	if path not in _SPLIT_CACHE:
+		import json
+
+		cache = {}
+		lines = 0
+		try:
+			with open(path) as file:
+				for lines, line in enumerate(file, 1):
+					try:
+						key, commit = json.loads(line)
+					except (ValueError, TypeError):  # a damaged line, e.g. from an interrupted write
+						continue
+					cache.pop(key, None)
+					if commit is not None:
+						cache[key] = commit
+		except OSError:  # no splits cached yet
+			pass
+		_SPLIT_CACHE[path] = cache
+		_SPLIT_CACHE_LINES[path] = lines
+	return _SPLIT_CACHE[path]
+
+
+def _close_batch_checks():
+	"""Terminate all `git cat-file --batch-check` processes."""
+	with _PROC_CACHE_LOCK:
+		processes = [process for process, _ in _PROC_CACHE.values()]
+		_PROC_CACHE.clear()
+	for process in processes:
+		process.stdin.close()
+		process.wait()
+		process.stdout.close()
+
+
+atexit.register(_close_batch_checks)
+
+
+class _Batch:
+	"""
+	Commands collected by `GitSubtree.batch` instead of being executed,
+	run as one ``&&`` chain when the ``with`` block exits.
+	"""
+
+	def __init__(self, subtree):
+		self.subtree = subtree
+		self.nested = False
+		self.result = None
+
+	def __enter__(self):
+		self.nested = self.subtree._pending is not None
+		if not self.nested:
+			self.subtree._pending = []
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if self.nested:
+			return
+		pending, self.subtree._pending = self.subtree._pending, None
+		if exc_type is None and pending:
+			self.result = self.subtree._run_chain(pending)
+
+
+class _Pipeline:
+	"""
+	Calls to `add`, `merge`, `split`, `pull` and `push` queued by
+	`GitSubtree.pipeline`, executed in order when the ``with`` block exits.
+	Each call uses the `prefix` the subtree had when it was queued.
+	"""
+
+	COMMANDS = ("add", "merge", "split", "pull", "push")
+
+	def __init__(self, subtree):
+		self.subtree = subtree
+		self.calls = []
+		self.results = []
+
+	def __getattr__(self, name):
+		if name not in self.COMMANDS:
+			raise AttributeError(name)
+		import inspect
+
+		signature = inspect.signature(getattr(type(self.subtree), name))
+
+		def queue(*args, **kwargs):
+			arguments = signature.bind(self.subtree, *args, **kwargs)
+			arguments.apply_defaults()
+			arguments = dict(arguments.arguments)
+			del arguments["self"]
+			self.calls.append((self.subtree.prefix, name, arguments))
+
+		return queue
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.results = self.subtree._flush(self.calls)
+		self.calls = []
+
+
+def _commit_id(result: subprocess.CompletedProcess):
+	"""The commit ID printed by a successful `split`, None otherwise."""
+	if result is None or result.returncode != 0:
+		return None
+	return result.stdout.strip().decode("ascii")
+
+
+def _asynchronous(method, finish=None):
+	"""
+	Generate the coroutine version of the `GitSubtree` `method`, passing
+	its result through `finish` like the method itself does.
+	"""
+
+	async def coroutine(self, *args, **kwargs):
+		self._recording = invocations = []
+		try:
+			method(self, *args, **kwargs)
+		finally:
+			self._recording = None
+		result = None
+		for args, capture in invocations:
+			result = await self._arun(*args, capture=capture)
+		return finish(result) if finish else result
+
+	coroutine.__name__ = f"a{method.__name__}"
+	coroutine.__qualname__ = f"GitSubtree.a{method.__name__}"
+	coroutine.__doc__ = f"""
+		Asynchronous version of `{method.__name__}`, taking the same arguments.
+
+		The command doesn't block the event loop, so independent operations
+		can run concurrently, e.g.
+		`await asyncio.gather(lib.apull(url, "main"), docs.apull(url, "docs"))`.
+		"""
+	return coroutine
+
+
+_SQUASH_HISTORY = (
+	"Instead of merging the entire history from the subtree project,\n"
+	"produce only a single commit that contains all the differences you\n"
+	"want to merge, and then merge that new commit into your project.\n"
+	"Using this option helps to reduce log clutter. People rarely want\n"
+	"to see every change that happened between v1.0 and v1.1 of the\n"
+	"library they’re using, since none of the interim versions were ever\n"
+	"included in their application.\n"
+	"Using `squash` also helps avoid problems when the same subproject\n"
+	"is included multiple times in the same project, or is removed and\n"
+	"then re_added. In such a case, it doesn’t make sense to combine the\n"
+	"histories anyway, since it’s unclear which part of the history\n"
+	"belongs to which subtree.\n"
+	"Furthermore, with `squash`, you can switch back and forth between\n"
+	"different versions of a subtree, rather than strictly forward.  git\n"
+	"subtree merge `squash` always adjusts the subtree to match the\n"
+	"exactly specified commit, even if getting to that commit would\n"
+	"require undoing some changes that were added earlier.\n"
+	"Whether or not you use `squash`, changes made in your local\n"
+	"repository remain intact and can be later split and send upstream\n"
+	"to the subproject."
+)
+"""The part of the `squash` documentation shared by all commands."""
+
+_DOCS = {
+	"squash_history": _SQUASH_HISTORY,
+	"squash": (
+		"Create only one commit that contains\n"
+		"all the changes, rather than merging in the entire history.\n"
+		"If you use `squash`, the merge direction doesn’t always have to be\n"
+		"forward; you can use this command to go back in time from v2.5 to\n"
+		"v2.4, for example. If your merge introduces a conflict, you can\n"
+		"resolve it in the usual ways.\n"
+		"When using `squash`, and the previous merge with `squash` merged an\n"
+		"annotated tag of the subtree repository, that tag needs to be\n"
+		"available locally. If `repository` is given, a missing tag will\n"
+		"automatically be fetched from that repository.\n"
+		+ _SQUASH_HISTORY
+	),
+	"annotate": (
+		"When generating synthetic history, add `annotation` as a prefix to\n"
+		"each commit message. Since we’re creating new commits with the same\n"
+		"commit message, but possibly different content, from the original\n"
+		"commits, this can help to differentiate them and avoid confusion.\n"
+		"Whenever you split, you need to use the same `annotation`, or else\n"
+		"you don’t have a guarantee that the new re_created history will be\n"
+		"identical to the old one. That will prevent merging from working\n"
+		"correctly. git subtree tries to make it work anyway, particularly\n"
+		"if you use `rejoin`, but it may not always be effective."
+	),
+	"branch": (
+		"After generating the synthetic history, create a new branch called\n"
+		"`branch` that contains the new history. This is suitable for\n"
+		"immediate pushing upstream. `branch` must not already exist."
+	),
+	"ignore_joins": (
+		"If you use `rejoin`, git subtree attempts to optimize its history\n"
+		"reconstruction to generate only the new commits since the last\n"
+		"`rejoin`.  `ignore_joins` disables this behavior, forcing it to\n"
+		"regenerate the entire history. In a large project, this can take a\n"
+		"long time."
+	),
+	"onto": (
+		"If your subtree was originally imported using something other than\n"
+		"git subtree, its history may not match what git subtree is\n"
+		"expecting. In that case, you can specify the commit ID `onto` that\n"
+		"corresponds to the first revision of the subproject’s history that\n"
+		"was imported into your project, and git subtree will attempt to\n"
+		"build its history from there.\n"
+		"If you used git subtree add, you should never need this option."
+	),
+	"rejoin": (
+		"After splitting, merge the newly created synthetic history back\n"
+		"into your main project. That way, future splits can search only the\n"
+		"part of history that has been added since the most recent `rejoin`.\n"
+		"If your split commits end up merged into the upstream subproject,\n"
+		"and then you want to get the latest upstream version, this will\n"
+		"allow git’s merge algorithm to more intelligently avoid conflicts\n"
+		"(since it knows these synthetic commits are already part of the\n"
+		"upstream repository).\n"
+		"Unfortunately, using this option results in git log showing an\n"
+		"extra copy of every new commit that was created (the original, and\n"
+		"the synthetic one).\n"
+		"If you do all your merges with `squash`, make sure you also use\n"
+		"`squash` when you split `rejoin`."
+	),
+	"message": (
+		"Specify `message` as the commit message for the merge commit."
+	),
+	"capture": (
+		"Collect the command's stdout in the returned process instead of\n"
+		"discarding it."
+	)
+}
+"""Documentation of the parameters shared by several commands, filled into their docstrings by `_documented`."""
+
+
+def _documented(method):
+	"""Fill the shared parameter documentation into the docstring of `method`, indented like the parameters."""
+	if method.__doc__:  # None when python strips docstrings, with -OO
+		method.__doc__ = method.__doc__.format_map(
+			{name: text.replace("\n", "\n\t\t\t") for name, text in _DOCS.items()}
+		)
+	return method
+
 
 class GitSubtree:
 	"""
@@ -53,115 +626,118 @@ class GitSubtree:
 	def __init__(
 		self,
 		repository_path: str,
-		command: str = "git subtree",
+		command: tuple = (_GIT, "subtree"),
 		prefix: str = None,
 		quiet: bool = False,
-		debug: bool = False
+		debug: bool = False,
+		backend: str = "git"
 	):
 		"""
 		:param repository_path:
 			Path to an existing git repository.
 		:param command:
-			Command to pass the generated git-subtree args to.
+			Command to pass the generated git-subtree args to, as its program
+			and arguments. A string is split like the shell would.
 		:param prefix:
 			Specify the path in the repository to the subtree you want to
 			manipulate. This option is mandatory for all commands.
 		:param quiet:
 			Suppress unnecessary output messages on stderr.
+		:param debug:
 			Produce even more unnecessary output messages on stderr.
+		:param backend:
+			"pygit2" to split without `rejoin` or `branch` in process,
+			creating the same commits as git subtree, which is still used
+			for everything else. Requires pygit2.
 		"""
+		if backend == "pygit2" and pygit2 is None:
+			warnings.warn("pygit2 is not installed, splitting with git subtree instead.")
+			backend = "git"
 		self.repository_path = repository_path
-		self.command = command
-		self.prefix = prefix
-		self.quiet = quiet
-		self.debug = debug
-
-	def add(self, local_commit: str, squash: bool = False, message: str = None):
+		self.command = tuple(shlex.split(command)) if isinstance(command, str) else tuple(command)
+		self._prefix = prefix
+		self._quiet = quiet
+		self._debug = debug
+		self._common_flags = None
+		self._location = None
+		self._cache_path = None
+		self._fetched = None
+		self._backend = backend
+		self._repository = None
+		self._recording = None
+		self._pending = None
+
+	@property
+	def prefix(self) -> str:
+		return self._prefix
+
+	@prefix.setter
+	def prefix(self, prefix: str):
+		self._prefix = prefix
+		self._common_flags = None
+
+	@property
+	def quiet(self) -> bool:
+		return self._quiet
+
+	@quiet.setter
+	def quiet(self, quiet: bool):
+		self._quiet = quiet
+		self._common_flags = None
+
+	@property
+	def debug(self) -> bool:
+		return self._debug
+
+	@debug.setter
+	def debug(self, debug: bool):
+		self._debug = debug
+		self._common_flags = None
+
+	@_documented
+	def add(
+		self,
+		repository: str = None,
+		remote_ref: str = None,
+		squash: bool = False,
+		message: str = None,
+		local_commit: str = None,
+		capture: bool = False
+	):
 		"""
 		Create the `prefix` subtree by importing its contents from the
-		given `local_commit`. A new commit is created automatically,
-		joining the imported project’s history with your own.
+		`repository` and `remote_ref`, or from the given `local_commit`. A
+		new commit is created automatically, joining the imported project’s
+		history with your own. If only one argument is given positionally,
+		it is taken as the `local_commit`.
 
 		:param squash:
 			Import only a single commit from the subproject,
 			rather than its entire history.
-			Instead of merging the entire history from the subtree project,
-			produce only a single commit that contains all the differences you
-			want to merge, and then merge that new commit into your project.
-			Using this option helps to reduce log clutter. People rarely want
-			to see every change that happened between v1.0 and v1.1 of the
-			library they’re using, since none of the interim versions were ever
-			included in their application.
-			Using `squash` also helps avoid problems when the same subproject
-			is included multiple times in the same project, or is removed and
-			then re_added. In such a case, it doesn’t make sense to combine the
-			histories anyway, since it’s unclear which part of the history
-			belongs to which subtree.
-			Furthermore, with `squash`, you can switch back and forth between
-			different versions of a subtree, rather than strictly forward.  git
-			subtree merge `squash` always adjusts the subtree to match the
-			exactly specified commit, even if getting to that commit would
-			require undoing some changes that were added earlier.
-			Whether or not you use `squash`, changes made in your local
-			repository remain intact and can be later split and send upstream
-			to the subproject.
+			{squash_history}
 
 		:param message:
-			Specify `message` as the commit message for the merge commit.
-		"""
-		self.__run(
-			"add",
-			{
-				"squash": squash,
-				"m": message
-			},
-			local_commit
-		)
+			{message}
 
-	def add(self, repository: str, remote_ref: str, squash: bool = False, message: str = None):
+		:param capture:
+			{capture}
 		"""
-		Create the `prefix` subtree by importing its contents from the
-		`repository` and `remote_ref`. A new commit is created
-		automatically, joining the imported project’s history with your own.
-
-		:param squash:
-			Import only a single commit from the subproject,
-			rather than its entire history.
-			Instead of merging the entire history from the subtree project,
-			produce only a single commit that contains all the differences you
-			want to merge, and then merge that new commit into your project.
-			Using this option helps to reduce log clutter. People rarely want
-			to see every change that happened between v1.0 and v1.1 of the
-			library they’re using, since none of the interim versions were ever
-			included in their application.
-			Using `squash` also helps avoid problems when the same subproject
-			is included multiple times in the same project, or is removed and
-			then re_added. In such a case, it doesn’t make sense to combine the
-			histories anyway, since it’s unclear which part of the history
-			belongs to which subtree.
-			Furthermore, with `squash`, you can switch back and forth between
-			different versions of a subtree, rather than strictly forward.  git
-			subtree merge `squash` always adjusts the subtree to match the
-			exactly specified commit, even if getting to that commit would
-			require undoing some changes that were added earlier.
-			Whether or not you use `squash`, changes made in your local
-			repository remain intact and can be later split and send upstream
-			to the subproject.
-
-		:param message:
-			Specify `message` as the commit message for the merge commit.
-		"""
-		self.__run(
-			"add",
-			{
-				"squash": squash,
-				"m": message
-			},
-			repository,
-			remote_ref
-		)
-
-	def merge(self, local_commit: str, repository: str = None, squash: bool = False, message: str = None):
+		if (
+			remote_ref is None and self.prefix and self.command == (_GIT, "subtree")
+			and _SHELL is not None and self._recording is None and self._pending is None
+		):
+			return self._fast_add(local_commit or repository, squash, message, capture)
+		return self._dispatch("add", locals())
+
+	@_documented
+	def merge(
+		self,
+		local_commit: str,
+		repository: str = None,
+		squash: bool = False,
+		message: str = None,
+		capture: bool = False
+	):
 		"""
 		Merge recent changes up to `local_commit` into the `prefix`
 		subtree. As with normal git merge, this doesn’t remove your own
@@ -169,128 +745,17 @@ class GitSubtree:
 		`local_commit`.
 
 		:param squash:
-			Create only one commit that contains
-			all the changes, rather than merging in the entire history.
-			If you use `squash`, the merge direction doesn’t always have to be
-			forward; you can use this command to go back in time from v2.5 to
-			v2.4, for example. If your merge introduces a conflict, you can
-			resolve it in the usual ways.
-			When using `squash`, and the previous merge with `squash` merged an
-			annotated tag of the subtree repository, that tag needs to be
-			available locally. If `repository` is given, a missing tag will
-			automatically be fetched from that repository.
-			Instead of merging the entire history from the subtree project,
-			produce only a single commit that contains all the differences you
-			want to merge, and then merge that new commit into your project.
-			Using this option helps to reduce log clutter. People rarely want
-			to see every change that happened between v1.0 and v1.1 of the
-			library they’re using, since none of the interim versions were ever
-			included in their application.
-			Using `squash` also helps avoid problems when the same subproject
-			is included multiple times in the same project, or is removed and
-			then re_added. In such a case, it doesn’t make sense to combine the
-			histories anyway, since it’s unclear which part of the history
-			belongs to which subtree.
-			Furthermore, with `squash`, you can switch back and forth between
-			different versions of a subtree, rather than strictly forward.  git
-			subtree merge `squash` always adjusts the subtree to match the
-			exactly specified commit, even if getting to that commit would
-			require undoing some changes that were added earlier.
-			Whether or not you use `squash`, changes made in your local
-			repository remain intact and can be later split and send upstream
-			to the subproject.
+			{squash}
 
 		:param message:
-			Specify `message` as the commit message for the merge commit.
-		"""
-		self.__run(
-			"merge",
-			{
-				"squash": squash,
-				"m": message
-			},
-			local_commit,
-			repository
-		)
+			{message}
 
-	def split(
-		self,
-		local_commit: str = None,
-		repository: str = None,
-		annotate: str = None,
-		branch: str = None,
-		ignore_joins: bool = False,
-		onto: str = None,
-	):
+		:param capture:
+			{capture}
 		"""
-		Extract a new, synthetic project history from the history of the
-		`prefix` subtree of `local_commit`, or of HEAD if no `local_commit`
-		is given. The new history includes only the commits (including
-		merges) that affected `prefix`, and each of those commits now has
-		the contents of `prefix` at the root of the project instead of in a
-		subdirectory. Thus, the newly created history is suitable for
-		export as a separate git repository.
-
-		After splitting successfully, a single commit ID is printed to
-		stdout. This corresponds to the HEAD of the newly created tree,
-		which you can manipulate however you want.
-
-		Repeated splits of exactly the same history are guaranteed to be
-		identical (i.e. to produce the same commit IDs) as long as the
-		settings passed to split (such as `annotate`) are the same. Because
-		of this, if you add new commits and then re_split, the new commits
-		will be attached as commits on top of the history you generated
-		last time, so git merge and friends will work as expected.
-
-		When a previous merge with `squash` merged an annotated tag of the
-		subtree repository, that tag needs to be available locally. If
-		`repository` is given, a missing tag will automatically be fetched
-		from that repository.
-
-		:param annotate:
-			When generating synthetic history, add `annotation` as a prefix to
-			each commit message. Since we’re creating new commits with the same
-			commit message, but possibly different content, from the original
-			commits, this can help to differentiate them and avoid confusion.
-			Whenever you split, you need to use the same `annotation`, or else
-			you don’t have a guarantee that the new re_created history will be
-			identical to the old one. That will prevent merging from working
-			correctly. git subtree tries to make it work anyway, particularly
-			if you use `rejoin`, but it may not always be effective.
-
-		:param branch:
-			After generating the synthetic history, create a new branch called
-			`branch` that contains the new history. This is suitable for
-			immediate pushing upstream. `branch` must not already exist.
-
-		:param ignore_joins:
-			If you use `rejoin`, git subtree attempts to optimize its history
-			reconstruction to generate only the new commits since the last
-			`rejoin`.  `ignore_joins` disables this behavior, forcing it to
-			regenerate the entire history. In a large project, this can take a
-			long time.
-
-		:param onto:
-			If your subtree was originally imported using something other than
-			git subtree, its history may not match what git subtree is
-			expecting. In that case, you can specify the commit ID `onto` that
-			corresponds to the first revision of the subproject’s history that
-			was imported into your project, and git subtree will attempt to
-			build its history from there.
-			If you used git subtree add, you should never need this option.
-		"""
-		self.__run(
-			"split",
-			{
-				"annotate": annotate,
-				"b": branch,
-				"ignore-joins": ignore_joins,
-				"onto": onto
-			},
-			local_commit,
-			repository
-		)
+		return self._dispatch("merge", locals())
 
+	@_documented
 	def split(
 		self,
 		local_commit: str = None,
@@ -302,7 +767,7 @@ class GitSubtree:
 		rejoin: bool = False,
 		squash: bool = False,
 		message: str = None
-	):
+	) -> str:
 		"""
 		Extract a new, synthetic project history from the history of the
 		`prefix` subtree of `local_commit`, or of HEAD if no `local_commit`
@@ -312,9 +777,10 @@ class GitSubtree:
 		subdirectory. Thus, the newly created history is suitable for
 		export as a separate git repository.
 
-		After splitting successfully, a single commit ID is printed to
-		stdout. This corresponds to the HEAD of the newly created tree,
-		which you can manipulate however you want.
+		After splitting successfully, the ID of a single commit is returned.
+		This corresponds to the HEAD of the newly created tree, which you
+		can manipulate however you want. None is returned if the split
+		failed.
 
 		Repeated splits of exactly the same history are guaranteed to be
 		identical (i.e. to produce the same commit IDs) as long as the
@@ -329,152 +795,83 @@ class GitSubtree:
 		from that repository.
 
 		:param annotate:
-			When generating synthetic history, add `annotation` as a prefix to
-			each commit message. Since we’re creating new commits with the same
-			commit message, but possibly different content, from the original
-			commits, this can help to differentiate them and avoid confusion.
-			Whenever you split, you need to use the same `annotation`, or else
-			you don’t have a guarantee that the new re_created history will be
-			identical to the old one. That will prevent merging from working
-			correctly. git subtree tries to make it work anyway, particularly
-			if you use `rejoin`, but it may not always be effective.
+			{annotate}
 
 		:param branch:
-			After generating the synthetic history, create a new branch called
-			`branch` that contains the new history. This is suitable for
-			immediate pushing upstream. `branch` must not already exist.
+			{branch}
 
 		:param ignore_joins:
-			If you use `rejoin`, git subtree attempts to optimize its history
-			reconstruction to generate only the new commits since the last
-			`rejoin`.  `ignore_joins` disables this behavior, forcing it to
-			regenerate the entire history. In a large project, this can take a
-			long time.
+			{ignore_joins}
 
 		:param onto:
-			If your subtree was originally imported using something other than
-			git subtree, its history may not match what git subtree is
-			expecting. In that case, you can specify the commit ID `onto` that
-			corresponds to the first revision of the subproject’s history that
-			was imported into your project, and git subtree will attempt to
-			build its history from there.
-			If you used git subtree add, you should never need this option.
+			{onto}
 
 		:param rejoin:
-			After splitting, merge the newly created synthetic history back
-			into your main project. That way, future splits can search only the
-			part of history that has been added since the most recent `rejoin`.
-			If your split commits end up merged into the upstream subproject,
-			and then you want to get the latest upstream version, this will
-			allow git’s merge algorithm to more intelligently avoid conflicts
-			(since it knows these synthetic commits are already part of the
-			upstream repository).
-			Unfortunately, using this option results in git log showing an
-			extra copy of every new commit that was created (the original, and
-			the synthetic one).
-			If you do all your merges with `squash`, make sure you also use
-			`squash` when you split `rejoin`.
+			{rejoin}
 
 		:param squash:
-			Create only one commit that contains
-			all the changes, rather than merging in the entire history.
-			If you use `squash`, the merge direction doesn’t always have to be
-			forward; you can use this command to go back in time from v2.5 to
-			v2.4, for example. If your merge introduces a conflict, you can
-			resolve it in the usual ways.
-			When using `squash`, and the previous merge with `squash` merged an
-			annotated tag of the subtree repository, that tag needs to be
-			available locally. If `repository` is given, a missing tag will
-			automatically be fetched from that repository.
-			Instead of merging the entire history from the subtree project,
-			produce only a single commit that contains all the differences you
-			want to merge, and then merge that new commit into your project.
-			Using this option helps to reduce log clutter. People rarely want
-			to see every change that happened between v1.0 and v1.1 of the
-			library they’re using, since none of the interim versions were ever
-			included in their application.
-			Using `squash` also helps avoid problems when the same subproject
-			is included multiple times in the same project, or is removed and
-			then re_added. In such a case, it doesn’t make sense to combine the
-			histories anyway, since it’s unclear which part of the history
-			belongs to which subtree.
-			Furthermore, with `squash`, you can switch back and forth between
-			different versions of a subtree, rather than strictly forward.  git
-			subtree merge `squash` always adjusts the subtree to match the
-			exactly specified commit, even if getting to that commit would
-			require undoing some changes that were added earlier.
-			Whether or not you use `squash`, changes made in your local
-			repository remain intact and can be later split and send upstream
-			to the subproject.
+			{squash}
 
 		:param message:
-			Specify `message` as the commit message for the merge commit.
-		"""
-		self.__run(
-			"split",
-			{
-				"annotate": annotate,
-				"b": branch,
-				"ignore-joins": ignore_joins,
-				"onto": onto,
-				"rejoin": rejoin,
-				"squash": squash,
-				"m": message
-			},
-			local_commit,
-			repository
-		)
-
-	def pull(self, repository: str, remote_ref: str, squash: bool = False, message: str = None):
+			{message}
+		"""
+		if (
+			self._backend == "pygit2" and self.prefix and not rejoin and not branch
+			and self._recording is None and self._pending is None
+		):
+			commit = self._pygit2_split(local_commit, annotate, ignore_joins, onto)
+			if commit is not None:
+				return commit
+		return _commit_id(self._dispatch("split", dict(locals(), capture=True)))
+
+	@_documented
+	def pull(
+		self,
+		repository: str,
+		remote_ref: str,
+		squash: bool = False,
+		message: str = None,
+		cache_first: bool = True,
+		capture: bool = False
+	):
 		"""
 		Exactly like merge, but parallels git pull in that it fetches the
 		given ref from the specified remote repository.
 
 		:param squash:
-			Create only one commit that contains
-			all the changes, rather than merging in the entire history.
-			If you use `squash`, the merge direction doesn’t always have to be
-			forward; you can use this command to go back in time from v2.5 to
-			v2.4, for example. If your merge introduces a conflict, you can
-			resolve it in the usual ways.
-			When using `squash`, and the previous merge with `squash` merged an
-			annotated tag of the subtree repository, that tag needs to be
-			available locally. If `repository` is given, a missing tag will
-			automatically be fetched from that repository.
-			Instead of merging the entire history from the subtree project,
-			produce only a single commit that contains all the differences you
-			want to merge, and then merge that new commit into your project.
-			Using this option helps to reduce log clutter. People rarely want
-			to see every change that happened between v1.0 and v1.1 of the
-			library they’re using, since none of the interim versions were ever
-			included in their application.
-			Using `squash` also helps avoid problems when the same subproject
-			is included multiple times in the same project, or is removed and
-			then re_added. In such a case, it doesn’t make sense to combine the
-			histories anyway, since it’s unclear which part of the history
-			belongs to which subtree.
-			Furthermore, with `squash`, you can switch back and forth between
-			different versions of a subtree, rather than strictly forward.  git
-			subtree merge `squash` always adjusts the subtree to match the
-			exactly specified commit, even if getting to that commit would
-			require undoing some changes that were added earlier.
-			Whether or not you use `squash`, changes made in your local
-			repository remain intact and can be later split and send upstream
-			to the subproject.
+			{squash}
 
 		:param message:
-			Specify `message` as the commit message for the merge commit.
-		"""
-		self.__run(
-			"pull",
-			{
-				"m": message,
-				"squash": squash
-			},
-			repository,
-			remote_ref
-		)
+			{message}
+
+		:param cache_first:
+			If `remote_ref` is a full commit ID that is already present
+			locally, or was already fetched from `repository` by an earlier
+			pull of the same pipeline, merge it directly instead of fetching
+			it again. Otherwise, pull always fetches.
 
+		:param capture:
+			{capture}
+		"""
+		if cache_first and _OBJECT_ID.fullmatch(remote_ref) and self._object_exists(remote_ref):
+			return self.merge(remote_ref, repository, squash=squash, message=message, capture=capture)
+		if self._recording is not None or self._pending is not None:  # the fetch can't be deferred
+			return self._dispatch("pull", locals())
+		# like git subtree pull, fetch and merge, but only fetch each ref once per pipeline
+		key = (repository, remote_ref)
+		commit = self._fetched.get(key) if cache_first and self._fetched is not None else None
+		if commit is None:
+			commits = self._fetch(repository, remote_ref)
+			if not commits:
+				return subprocess.CompletedProcess(
+					self.to_args("pull", {"squash": squash, "m": message}, repository, remote_ref), 1, b"" if capture else None
+				)
+			commit = commits[0]  # what FETCH_HEAD, merged by git subtree pull, resolves to
+			if self._fetched is not None:
+				self._fetched[key] = commit
+		return self.merge(commit, repository, squash=squash, message=message, capture=capture)
+
+	@_documented
 	def push(
 		self,
 		repository: str,
@@ -484,428 +881,1091 @@ class GitSubtree:
 		branch: str = None,
 		ignore_joins: bool = False,
 		onto: str = None,
+		rejoin: bool = False,
+		squash: bool = False,
+		message: str = None,
+		capture: bool = False
 	):
 		"""
 		Does a split using the `prefix` subtree of `local_commit` and then
 		does a git push to push the result to the `repository` and
 		`remote_ref`. This can be used to push your subtree to different
 		branches of the remote repository. Just as with split, if no
-		`local_commit` is given, then HEAD is used.
+		`local_commit` is given, then HEAD is used. `remote_ref` is
+		required, a ValueError is raised without it.
 
 		:param annotate:
-			When generating synthetic history, add `annotation` as a prefix to
-			each commit message. Since we’re creating new commits with the same
-			commit message, but possibly different content, from the original
-			commits, this can help to differentiate them and avoid confusion.
-			Whenever you split, you need to use the same `annotation`, or else
-			you don’t have a guarantee that the new re_created history will be
-			identical to the old one. That will prevent merging from working
-			correctly. git subtree tries to make it work anyway, particularly
-			if you use `rejoin`, but it may not always be effective.
+			{annotate}
 
 		:param branch:
-			After generating the synthetic history, create a new branch called
-			`branch` that contains the new history. This is suitable for
-			immediate pushing upstream. `branch` must not already exist.
+			{branch}
 
 		:param ignore_joins:
-			If you use `rejoin`, git subtree attempts to optimize its history
-			reconstruction to generate only the new commits since the last
-			`rejoin`.  `ignore_joins` disables this behavior, forcing it to
-			regenerate the entire history. In a large project, this can take a
-			long time.
+			{ignore_joins}
 
 		:param onto:
-			If your subtree was originally imported using something other than
-			git subtree, its history may not match what git subtree is
-			expecting. In that case, you can specify the commit ID `onto` that
-			corresponds to the first revision of the subproject’s history that
-			was imported into your project, and git subtree will attempt to
-			build its history from there.
-			If you used git subtree add, you should never need this option.
-		"""
-		self.__run(
-			"push",
-			{
-				"annotate": annotate,
-				"b": branch,
-				"ignore-joins": ignore_joins,
-				"onto": onto
-			},
-			repository,
-			local_commit,
-			remote_ref
+			{onto}
+
+		:param rejoin:
+			{rejoin}
+
+		:param squash:
+			{squash}
+
+		:param message:
+			{message}
+
+		:param capture:
+			{capture}
+		"""
+		if remote_ref is None:
+			raise ValueError("push needs the remote_ref to push to.")
+		refspec = f"{local_commit}:{remote_ref}" if local_commit else remote_ref  # git subtree takes one refspec
+		return self._dispatch("push", locals())
+
+	def _dispatch(self, command: str, parameters: dict) -> subprocess.CompletedProcess:
+		"""Execute `command` with the options and arguments picked from the method's `parameters`."""
+		options, arguments = _OPT_TEMPLATES[command]
+		return self.__run(
+			command,
+			{option: parameters[parameter] for option, parameter in options if parameters[parameter]},  # unused left out
+			*(parameters[parameter] for parameter in arguments),
+			capture=parameters["capture"]
 		)
 
-	def push(
+	def to_args(self, command: str, options: dict, *args) -> list:
+		"""Convert the command, options and args to a list of strings to be passed to `subprocess.run`."""
+		if self._common_flags is None:  # only rebuilt after `quiet`, `debug` or `prefix` changed
+			self._common_flags = (
+				(("-q",) if self.quiet else ())
+				+ (("-d",) if self.debug else ())
+				+ (("-P", self.prefix) if self.prefix else ())
+			)
+		argv = [self.command[0]]
+		if self.command[0] == _GIT:
+			argv.extend(self._git_location())
+		argv.extend(self.command[1:])
+		argv.append(command)
+		argv.extend(self._common_flags)
+		for key, value in options.items():  # the commands leave out unused options, but they may come from elsewhere
+			if key in _FLAGS:
+				if value:
+					argv.append(_switch(key))
+			elif key in _VALUED:
+				if value is not None:
+					argv.extend((_switch(key), str(value)))  # separate argv items, example: -m <message>
+			else:
+				raise ValueError(f"Unknown git subtree option {key!r}.")
+		argv.extend(str(argument) for argument in args if argument is not None)
+		return argv
+
+	def __run(self, command, options: dict, *args, capture: bool = False) -> subprocess.CompletedProcess:
+		"""
+		Execute the `git-subtree` command.
+
+		Splits without `rejoin` or `branch` only depend on the command, the
+		split commit, the commit `onto` names and their other options, so
+		their commit IDs are cached by those, shared by all instances and
+		threads and kept in the repository's `subtree-cache.jsonl`. Nothing
+		references the split commits, so `git gc` may prune them; such
+		results are dropped when hit.
+
+		:return: The finished process; its stdout is None unless `capture`.
+			None when the command is only collected, see `batch`.
+		"""
+		if self._recording is not None:  # building the command for the asynchronous variant
+			self._recording.append(((command, options, *args), capture))
+			return
+		if self._pending is not None:  # collected by `batch`
+			self._pending.append((self.to_args(command, options, *args), capture))
+			return
+		key = None
+		if command == "split" and capture and not options.get("rejoin") and not options.get("b"):
+			commit = self._resolve(args[0])
+			onto = options.get("onto")
+			if onto is not None:  # a ref can move, so key by the commit it names
+				onto = self._resolve(onto)
+				if onto is None:  # leave the error to git subtree
+					commit = None
+			if commit is not None:
+				import json
+
+				key = json.dumps([self.command, self.prefix, commit, sorted({**options, "onto": onto}.items()), *args[1:]])
+				with _SPLIT_CACHE_LOCK:
+					split = _split_cache(self._split_cache_path()).get(key)
+				if split is not None:
+					if _batch_check(self.repository_path, split) == "commit":
+						return subprocess.CompletedProcess(self.to_args(command, options, *args), 0, f"{split}\n".encode())
+					self._store_split(key, None)  # pruned since
+		args = self.to_args(command, options, *args)
+		result = subprocess.CompletedProcess(args, *self.__execute(args, capture))
+		if not capture:
+			result.stdout = None
+		if key is not None and result.returncode == 0:
+			self._store_split(key, result.stdout.strip().decode("ascii"))
+		return result
+
+	def _split_cache_path(self) -> str:
+		"""The path of the file the split results of the repository are kept in."""
+		if self._cache_path is None:
+			path = self._git("rev-parse", "--git-path", "subtree-cache.jsonl")[1].strip().decode()
+			self._cache_path = os.path.realpath(os.path.join(self.repository_path, path))
+		return self._cache_path
+
+	def _store_split(self, key: str, commit: str):
+		"""
+		Cache the `commit` ID of the split with the given `key`, or remove
+		it if `commit` is None, in memory and on disk, see `_split_cache`.
+		"""
+		import json
+
+		path = self._split_cache_path()
+		with _SPLIT_CACHE_LOCK:
+			cache = _split_cache(path)
+			cache.pop(key, None)
+			if commit is not None:
+				cache[key] = commit
+			temporary = None
+			try:
+				if _SPLIT_CACHE_LINES[path] < 2 * _SPLIT_CACHE_SIZE:
+					with open(path, "a") as file:
+						file.write(json.dumps([key, commit]) + "\n")
+					_SPLIT_CACHE_LINES[path] += 1
+				else:  # compact the file to the most recent results
+					for old in list(cache)[:-_SPLIT_CACHE_SIZE]:
+						del cache[old]
+					temporary = f"{path}.{os.urandom(16).hex()}"
+					with open(temporary, "w") as file:
+						file.writelines(json.dumps(entry) + "\n" for entry in cache.items())
+					os.replace(temporary, path)  # never leave a partially written cache behind
+					_SPLIT_CACHE_LINES[path] = len(cache)
+			except OSError:  # e.g. a read-only repository, keep the results in memory only
+				if temporary is not None and os.path.exists(temporary):
+					os.remove(temporary)
+
+	def _pygit2_split(self, local_commit: str = None, annotate: str = None, ignore_joins: bool = False, onto: str = None):
+		"""
+		`split` in process with pygit2, following the steps of git subtree
+		split so that it creates the same commits.
+
+		:return: The new commit ID, or None for anything git subtree should
+			handle, such as errors, which it reports.
+		"""
+		if self._repository is None:
+			self._repository = pygit2.Repository(self.repository_path)
+		repository = self._repository
+		config = repository.config
+		if "commit.gpgSign" in config or "i18n.commitEncoding" in config:
+			return None  # git would sign or re-encode the commits
+		directory = self.prefix[:-1] if self.prefix.endswith("/") else self.prefix
+		cache, notree = {}, set()  # original commit -> split commit, and commits without the subtree
+
+		def resolve(revision: str):
+			try:
+				return str(repository.revparse_single(revision).peel(pygit2.Commit).id)
+			except (KeyError, ValueError, pygit2.GitError):
+				return None
+
+		def cache_set(old: str, new: str):
+			if old in cache:
+				raise LookupError(f"cache for {old} already exists")
+			cache[old] = new
+
+		def process(commit: str, parents: list):
+			nonlocal latest
+			if commit in cache:
+				return
+			for parent in parents:
+				if parent not in cache and parent not in notree:  # not listed, e.g. behind an earlier split
+					process(parent, [str(grandparent) for grandparent in repository[parent].parent_ids])
+			new_parents = [cache[parent] for parent in parents if parent in cache]
+			entry = repository[commit].tree[directory] if directory in repository[commit].tree else None
+			if entry is not None and entry.type_str not in ("tree", "commit"):
+				raise LookupError(f"{directory} is not a directory")
+			if entry is None or entry.type_str == "commit":  # submodules don't count
+				notree.add(commit)
+				if new_parents:
+					cache_set(commit, commit)
+				return
+			new = copy_or_skip(commit, str(entry.id), new_parents)
+			cache_set(commit, new)
+			latest = (commit, new)
+
+		def copy_or_skip(commit: str, tree: str, new_parents: list) -> str:
+			identical = nonidentical = None
+			copy = False
+			unique_parents = []
+			for parent in new_parents:
+				if str(repository[parent].peel(pygit2.Tree).id) == tree:
+					if identical is None:
+						identical = parent
+					else:
+						base = repository.merge_base(identical, parent)
+						base = str(base) if base is not None else None
+						if base == identical:
+							identical = parent
+						elif base != parent:  # no common history
+							copy = True
+				else:
+					nonidentical = parent
+				if parent not in unique_parents:
+					unique_parents.append(parent)
+			if identical is not None and nonidentical is not None and not (
+				identical == nonidentical or repository.descendant_of(identical, nonidentical)
+			):
+				copy = True  # preserve the history along the other branch
+			if identical is not None and not copy:
+				return identical
+			original = repository[commit]
+			if original.message_encoding is not None:
+				raise LookupError(f"{commit} would be re-encoded")
+			return str(repository.create_commit(
+				None,
+				original.author,
+				original.committer,
+				(annotate or "") + original.read_raw().partition(b"\n\n")[2].decode(),  # verbatim, like git log's %B
+				pygit2.Oid(hex=tree),
+				[pygit2.Oid(hex=parent) for parent in unique_parents]
+			))
+
+		tip = resolve(local_commit or "HEAD")
+		if tip is None:
+			return None
+		latest = None
+		try:
+			if onto:
+				base = resolve(onto)
+				if base is None:
+					return None
+				for commit in repository.walk(base):
+					cache_set(str(commit.id), str(commit.id))  # already just the subtree
+			pattern = (
+				f"^Add '{re.escape(directory)}/' from commit '" if ignore_joins
+				else f"^git-subtree-dir: {re.escape(directory)}/*$"
+			)
+			hidden = []
+			for commit in repository.walk(tip, pygit2.GIT_SORT_TIME):  # find the existing splits
+				if not re.search(pattern, commit.message, re.MULTILINE):
+					continue
+				subject, _, body = commit.message.partition("\n\n")
+				main = sub = None
+				for line in (" ".join(subject.splitlines()), *body.splitlines()):
+					words = line.split()
+					if words[:1] == ["git-subtree-mainline:"]:
+						main = words[1] if len(words) > 1 else None
+					elif words[:1] == ["git-subtree-split:"]:
+						sub = resolve(words[1]) if len(words) > 1 else None
+						if sub is None:
+							return None  # maybe a tag git subtree would fetch first
+				if main is None and sub is not None:  # squash commits refer to a subtree
+					cache_set(str(commit.id), sub)
+				if main is not None and sub is not None:
+					cache_set(main, sub)
+					cache_set(sub, sub)
+					hidden.extend(filter(None, (resolve(f"{main}^"), resolve(f"{sub}^"))))
+			walker = repository.walk(tip, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
+			for commit in hidden:
+				walker.hide(commit)
+			for commit in walker:
+				process(str(commit.id), [str(parent) for parent in commit.parent_ids])
+		except (LookupError, ValueError, UnicodeDecodeError, RecursionError, pygit2.GitError):
+			return None
+		if latest is None or latest[0] != tip:
+			return None  # which commit was the latest depends on git's walk order
+		return latest[1]
+
+	def _fast_add(
 		self,
-		repository: str,
-		local_commit: str = None,
-		remote_ref: str = None,
-		annotate: str = None,
-		branch: str = None,
-		ignore_joins: bool = False,
-		onto: str = None,
-		rejoin: bool = False,
+		local_commit: str,
 		squash: bool = False,
-		message: str = None
-	):
+		message: str = None,
+		capture: bool = False
+	) -> subprocess.CompletedProcess:
 		"""
-		Does a split using the `prefix` subtree of `local_commit` and then
-		does a git push to push the result to the `repository` and
-		`remote_ref`. This can be used to push your subtree to different
-		branches of the remote repository. Just as with split, if no
-		`local_commit` is given, then HEAD is used.
+		`add` the `local_commit` by running the git plumbing commands of
+		`git subtree add` directly instead of through its shell script,
+		creating the same commits.
 
-		:param annotate:
-			When generating synthetic history, add `annotation` as a prefix to
-			each commit message. Since we’re creating new commits with the same
-			commit message, but possibly different content, from the original
-			commits, this can help to differentiate them and avoid confusion.
-			Whenever you split, you need to use the same `annotation`, or else
-			you don’t have a guarantee that the new re_created history will be
-			identical to the old one. That will prevent merging from working
-			correctly. git subtree tries to make it work anyway, particularly
-			if you use `rejoin`, but it may not always be effective.
+		:return: A process standing for the equivalent `git subtree add`,
+			with the exit status of the first failing command.
+		"""
+		result = subprocess.CompletedProcess(
+			self.to_args("add", {"squash": squash, "m": message}, local_commit), 0, b"" if capture else None
+		)
 
-		:param branch:
-			After generating the synthetic history, create a new branch called
-			`branch` that contains the new history. This is suitable for
-			immediate pushing upstream. `branch` must not already exist.
+		def git(*args) -> str:
+			returncode, stdout = self._git(*args)
+			if returncode != 0:
+				raise subprocess.CalledProcessError(returncode, args)
+			return stdout.strip().decode()
+
+		directory = posixpath.dirname(f"{self.prefix.removesuffix('/')}/.")
+		try:
+			if git("rev-parse", "--show-prefix") or os.path.lexists(os.path.join(self.repository_path, directory)):
+				result.returncode = 1  # like git subtree, only run from the top level, and never replace anything
+				return result
+			git("diff-index", "HEAD", "--exit-code", "--quiet")
+			git("diff-index", "--cached", "HEAD", "--exit-code", "--quiet")
+			commit = git("rev-parse", "--verify", f"{local_commit}^{{commit}}")
+			git("read-tree", f"--prefix={directory}", commit)
+			git("checkout", "--", directory)
+			tree = git("write-tree")
+			head = git("rev-parse", "--verify", "HEAD")
+			parents = ("-p", head) if head != commit else ()
+			if squash:
+				squashed = git(
+					"commit-tree", f"{commit}^{{tree}}", "-m",
+					f"Squashed '{directory}/' content from commit {git('rev-parse', '--short', commit)}\n\n"
+					f"git-subtree-dir: {directory}\n"
+					f"git-subtree-split: {commit}\n"
+				)
+				message = message or f"Merge commit '{squashed}' as '{directory}'"
+				merge = git("commit-tree", tree, *parents, "-p", squashed, "-m", f"{message}\n")
+			else:
+				message = message or f"Add '{directory}/' from commit '{commit}'"
+				merge = git(
+					"commit-tree", tree, *parents, "-p", commit, "-m",
+					f"{message}\n\n"
+					f"git-subtree-dir: {directory}\n"
+					f"git-subtree-mainline: {head}\n"
+					f"git-subtree-split: {commit}\n"
+				)
+			git("reset", "--quiet", merge)
+		except subprocess.CalledProcessError as error:
+			result.returncode = error.returncode
+		return result
+
+	def batch(self):
+		"""
+		Collect the commands run inside the ``with`` block and run them
+		in order with a single command line when it exits:
+
+			with subtree.batch() as batch:
+				subtree.pull(url, "main")
+				subtree.push(url, remote_ref="main")
+			batch.result.check_returncode()
+
+		The chain stops at the first failing command; only the overall exit
+		status and the combined stdout are reported, in the process stored
+		as `result`, whose `args` lists every collected command. Methods
+		return None inside the block.
+		"""
+		return _Batch(self)
+
+	def _run_chain(self, commands: list) -> subprocess.CompletedProcess:
+		"""Run the (args, capture) `commands` one after the other until one fails."""
+		if _SHELL is None:  # no shell to chain the commands in
+			returncode, stdout = 0, b""
+			for args, capture in commands:
+				returncode, output = self.__execute(args, capture)
+				stdout += output
+				if returncode != 0:
+					break
+		else:
+			returncode, stdout = _POOL.run(
+				" && ".join(_Helper.command_line(args, capture) for args, capture in commands),
+				self.repository_path
+			)
+		return subprocess.CompletedProcess([args for args, _ in commands], returncode, stdout)
+
+	def pipeline(self):
+		"""
+		Queue commands and run them together when the ``with`` block exits:
+
+			with subtree.pipeline() as pipeline:
+				pipeline.split(annotate="(lib) ")
+				pipeline.push(url, remote_ref="main", annotate="(lib) ")
+
+		`pipeline.results` then holds one result per queued call, in order.
+		A `split` directly followed by a `push` of the same subtree and
+		history is dropped, since `push` does the same split itself, and
+		its result is None. All `add` calls importing from the same
+		repository share a single `git fetch`, and `pull` calls of the same
+		ref fetch it only once.
+		"""
+		return _Pipeline(self)
+
+	def _flush(self, calls: list) -> list:
+		"""Run the `calls` queued by a pipeline and return their results, None for the dropped splits."""
+		dropped = [self.__fused(call, following) for call, following in zip(calls, calls[1:] + [None])]
+
+		fetched = {}
+		refs = {}
+		for (_, name, arguments), skip in zip(calls, dropped):
+			if not skip and name == "add" and arguments["remote_ref"] is not None:
+				refs.setdefault(arguments["repository"], []).append(arguments["remote_ref"])
+		for repository, remote_refs in refs.items():
+			remote_refs = list(dict.fromkeys(remote_refs))
+			commits = self._fetch(repository, *remote_refs)
+			if len(commits) == len(remote_refs):
+				fetched.update(((repository, ref), commit) for ref, commit in zip(remote_refs, commits))
+
+		prefix = self.prefix
+		results = []
+		self._fetched = {}  # pulls of the same ref share a fetch within the pipeline
+		try:
+			for (self.prefix, name, arguments), skip in zip(calls, dropped):
+				if skip:
+					results.append(None)
+					continue
+				source = (arguments.get("repository"), arguments.get("remote_ref"))
+				if name == "add" and source in fetched:  # add the fetched commit instead
+					arguments.update(local_commit=fetched[source], repository=None, remote_ref=None)
+				results.append(getattr(self, name)(**arguments))
+		finally:
+			self.prefix = prefix
+			self._fetched = None
+		return results
+
+	@staticmethod
+	def __fused(call, following) -> bool:
+		"""Whether the split `call` is redundant because the `following` push performs the same split."""
+		if following is None:
+			return False
+		(prefix, name, arguments), (following_prefix, following_name, following_arguments) = call, following
+		return (
+			name == "split" and following_name == "push" and prefix == following_prefix
+			and not arguments["rejoin"] and arguments["branch"] is None
+			and all(
+				arguments[key] == following_arguments[key]
+				for key in ("local_commit", "annotate", "ignore_joins", "onto")
+			)
+		)
 
-		:param ignore_joins:
-			If you use `rejoin`, git subtree attempts to optimize its history
-			reconstruction to generate only the new commits since the last
-			`rejoin`.  `ignore_joins` disables this behavior, forcing it to
-			regenerate the entire history. In a large project, this can take a
-			long time.
+	def _fetch(self, repository: str, *remote_refs) -> list:
+		"""Fetch `remote_refs` from `repository` at once and return the fetched commit IDs in order."""
+		if self._git("fetch", repository, *remote_refs)[0] != 0:
+			return []
+		fetch_head = os.path.join(self.repository_path, self._git("rev-parse", "--git-path", "FETCH_HEAD")[1].strip().decode())
+		with open(fetch_head) as file:
+			return [line.split("\t", 1)[0] for line in file if line.strip()]
 
-		:param onto:
-			If your subtree was originally imported using something other than
-			git subtree, its history may not match what git subtree is
-			expecting. In that case, you can specify the commit ID `onto` that
-			corresponds to the first revision of the subproject’s history that
-			was imported into your project, and git subtree will attempt to
-			build its history from there.
-			If you used git subtree add, you should never need this option.
+	def _object_exists(self, object_id: str) -> bool:
+		"""Whether the commit `object_id` is present locally, checked without any network access."""
+		return _batch_check(self.repository_path, f"{object_id}^{{commit}}") == "commit"
 
-		:param rejoin:
-			After splitting, merge the newly created synthetic history back
-			into your main project. That way, future splits can search only the
-			part of history that has been added since the most recent `rejoin`.
-			If your split commits end up merged into the upstream subproject,
-			and then you want to get the latest upstream version, this will
-			allow git’s merge algorithm to more intelligently avoid conflicts
-			(since it knows these synthetic commits are already part of the
-			upstream repository).
-			Unfortunately, using this option results in git log showing an
-			extra copy of every new commit that was created (the original, and
-			the synthetic one).
-			If you do all your merges with `squash`, make sure you also use
-			`squash` when you split `rejoin`.
+	def _git(self, *args) -> tuple:
+		"""Run a git command in the repository and return its exit status and stdout."""
+		return self.__execute((_GIT, *self._git_location(), *args))
 
-		:param squash:
-			Create only one commit that contains
-			all the changes, rather than merging in the entire history.
-			If you use `squash`, the merge direction doesn’t always have to be
-			forward; you can use this command to go back in time from v2.5 to
-			v2.4, for example. If your merge introduces a conflict, you can
-			resolve it in the usual ways.
-			When using `squash`, and the previous merge with `squash` merged an
-			annotated tag of the subtree repository, that tag needs to be
-			available locally. If `repository` is given, a missing tag will
-			automatically be fetched from that repository.
-			Instead of merging the entire history from the subtree project,
-			produce only a single commit that contains all the differences you
-			want to merge, and then merge that new commit into your project.
-			Using this option helps to reduce log clutter. People rarely want
-			to see every change that happened between v1.0 and v1.1 of the
-			library they’re using, since none of the interim versions were ever
-			included in their application.
-			Using `squash` also helps avoid problems when the same subproject
-			is included multiple times in the same project, or is removed and
-			then re_added. In such a case, it doesn’t make sense to combine the
-			histories anyway, since it’s unclear which part of the history
-			belongs to which subtree.
-			Furthermore, with `squash`, you can switch back and forth between
-			different versions of a subtree, rather than strictly forward.  git
-			subtree merge `squash` always adjusts the subtree to match the
-			exactly specified commit, even if getting to that commit would
-			require undoing some changes that were added earlier.
-			Whether or not you use `squash`, changes made in your local
-			repository remain intact and can be later split and send upstream
-			to the subproject.
-
-			:param message:
-				Specify `message` as the commit message for the merge commit.
-		"""
-		self.__run(
-			"push",
-			{
-				"annotate": annotate,
-				"b": branch,
-				"ignore-joins": ignore_joins,
-				"onto": onto,
-				"rejoin": rejoin,
-				"squash": squash,
-				"m": message
-			},
-			repository,
-			local_commit,
-			remote_ref
+	def _git_location(self) -> tuple:
+		"""
+		The ``--git-dir`` and ``--work-tree`` options for git, looked up once
+		so that every later git process can skip the repository discovery.
+		"""
+		if self._location is None:
+			returncode, stdout = self.__execute((_GIT, "rev-parse", "--absolute-git-dir", "--show-toplevel"))
+			paths = stdout.decode().splitlines()
+			if returncode == 0 and len(paths) == 2:
+				self._location = (f"--git-dir={paths[0]}", f"--work-tree={paths[1]}")
+			else:  # e.g. a bare repository, leave the discovery to git
+				self._location = ()
+		return self._location
+
+	def __execute(self, args, capture: bool = True) -> tuple:
+		"""Run `args` in the repository and return its exit status and stdout, empty unless `capture`."""
+		if _SHELL is None:  # no shell to keep around
+			process = subprocess.run(
+				args,
+				executable=_which(args[0]),
+				cwd=self.repository_path,
+				stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+				stderr=subprocess.DEVNULL,
+				env=_environment(),
+				close_fds=False,  # python's own file descriptors aren't inheritable anyway
+				shell=False
+			)
+			return process.returncode, process.stdout or b""
+		return _POOL.run(_Helper.command_line(args, capture), self.repository_path)
+
+	def _resolve(self, revision: str = None):
+		"""Resolve `revision`, HEAD by default, to a commit ID, or None if it doesn't name a commit."""
+		returncode, stdout = self._git("rev-parse", "--verify", "--quiet", f"{revision or 'HEAD'}^{{commit}}")
+		return stdout.strip().decode() if returncode == 0 else None
+
+	async def _arun(self, command, options: dict, *args, capture: bool = False) -> subprocess.CompletedProcess:
+		"""Execute the `git-subtree` command without blocking the event loop."""
+		args = self.to_args(command, options, *args)
+		program, *arguments = args
+		if program == _GIT:  # git changes into the repository by itself, without cwd python can use posix_spawn
+			spawned, cwd = (_which(program) or program, "-C", os.path.abspath(self.repository_path), *arguments), None
+		else:
+			spawned, cwd = args, self.repository_path
+		import asyncio
+
+		process = await asyncio.create_subprocess_exec(
+			*spawned,
+			cwd=cwd,
+			stdout=asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL,
+			stderr=asyncio.subprocess.DEVNULL,
+			env=_environment(),
+			close_fds=False
 		)
+		stdout, _ = await process.communicate()
+		return subprocess.CompletedProcess(args, process.returncode, stdout)
 
-	def to_args(self, command: str, options: dict, *args):
-		"""Convert the command, options and args to a list of strings to be passed to `subprocess.run`."""
-		options.update({
-			"q": self.quiet,
-			"d": self.debug,
-			"P": self.prefix
-		})
-		for key, value in options.items():
-			if value:
-				short = len(key) > 1
-				argument = f"-{key}"
-				if short:
-					argument = f"-{argument}"
-				if value is not True:  # meaning it's not a flag
-					argument += f"{'=' if short else ' '}{value}"  # example: -m <message>, --message=<message>
-				args += (argument,)
-		return (self.command, command) + tuple(filter(lambda argument: argument is not None, args))
-
-	def __run(self, command, options: dict, *args):
-		"""Execute the `git-subtree` command."""
-		subprocess.run(
-			self.to_args(command, options, *args),
-			cwd=self.repository_path,
-			stdout=subprocess.PIPE,
-			stderr=subprocess.PIPE
-		)
+	aadd = _asynchronous(add)
+	amerge = _asynchronous(merge)
+	asplit = _asynchronous(split, _commit_id)
+	apull = _asynchronous(pull)
+	apush = _asynchronous(push)
 
+	@staticmethod
+	def map(instances, method: str, *args, max_workers: int = 8, **kwargs) -> list:
+		"""
+		Call `method` with the given arguments on all `instances` concurrently,
+		e.g. `GitSubtree.map(subtrees, "pull", url, "main")`, and return the
+		results in order.
 
-if __name__ == "__main__":
-	# region Parse command line arguments
+		The commands spend their time waiting for git, mostly on the network
+		for `pull` and `push`, so threads are enough to run them in parallel.
+
+		:param max_workers:
+			The maximum number of commands running at the same time.
+		"""
+		_POOL.size = max(_POOL.size, max_workers)  # a helper shell for every thread
+		return list(_executor(max_workers).map(lambda instance: getattr(instance, method)(*args, **kwargs), instances))
+
+	def map_split(self, prefixes, local_commit: str = None, max_workers: int = None, **options) -> dict:
+		"""
+		Split the subtrees at all `prefixes` of this repository concurrently
+		and return their new commit IDs by prefix, None for failed splits.
+
+		Without `rejoin`, split only reads the object database and writes
+		its scratch files to a directory of its own, so the splits share
+		this repository without stepping on each other.
+
+		:param local_commit:
+			The commit to split the subtrees of, HEAD if not given.
+		:param max_workers:
+			The maximum number of splits running at the same time, the
+			number of CPUs if not given.
+		:param options:
+			Further arguments to `split`, except `rejoin`, which commits to
+			HEAD. A `branch` has to be unique to one prefix.
+		"""
+		if options.get("rejoin"):
+			raise ValueError("Splits with rejoin commit to HEAD and can't run concurrently.")
+		subtrees = [
+			GitSubtree(self.repository_path, self.command, prefix, self.quiet, self.debug, self._backend)
+			for prefix in prefixes
+		]
+		commits = GitSubtree.map(subtrees, "split", local_commit, max_workers=max_workers or os.cpu_count() or 1, **options)
+		return dict(zip(prefixes, commits))
+
+	@staticmethod
+	async def amap(instances, method: str, *args, **kwargs) -> list:
+		"""Asynchronous version of `map`, running the `method` coroutines of all `instances` concurrently."""
+		import asyncio
+
+		return await asyncio.gather(*(getattr(instance, f"a{method}")(*args, **kwargs) for instance in instances))
+
+	@staticmethod
+	def shutdown_pool():
+		"""Terminate the helper processes shared by all instances. This also happens at exit."""
+		_POOL.shutdown()
+		_close_batch_checks()
+
+
+def _delegate(name: str):
+	"""Generate the `AsyncGitSubtree` command `name`, awaiting the coroutine version of the `GitSubtree` one."""
+
+	async def coroutine(self, *args, **kwargs):
+		return await getattr(self.subtree, f"a{name}")(*args, **kwargs)
+
+	coroutine.__name__ = name
+	coroutine.__qualname__ = f"AsyncGitSubtree.{name}"
+	coroutine.__doc__ = getattr(GitSubtree, name).__doc__
+	return coroutine
+
+
+class AsyncGitSubtree:
+	"""
+	`GitSubtree` with coroutines for commands, taking the same arguments,
+	which don't block the event loop while git runs:
+
+		lib = AsyncGitSubtree(".", prefix="lib")
+		docs = AsyncGitSubtree(".", prefix="docs")
+		await asyncio.gather(lib.split(), docs.split())
+
+	Commands that change the repository commit to HEAD and must not run
+	concurrently on the same repository. Splits without `rejoin`, into
+	distinct branches if any, only read it and can.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		"""Takes the same arguments as `GitSubtree`; the wrapped instance is kept as `subtree`."""
+		self.subtree = GitSubtree(*args, **kwargs)
+
+	def __getattr__(self, name):
+		return getattr(self.subtree, name)
+
+	add = _delegate("add")
+	merge = _delegate("merge")
+	split = _delegate("split")
+	pull = _delegate("pull")
+	push = _delegate("push")
+
+
+_HELP_SQUASH = (
+	"Instead of merging the entire history from the subtree project,\n"
+	"produce only a single commit that contains all the differences you\n"
+	"want to merge, and then merge that new commit into your project.\n"
+	"Using this option helps to reduce log clutter. People rarely want\n"
+	"to see every change that happened between v1.0 and v1.1 of the\n"
+	"library they’re using, since none of the interim versions were ever\n"
+	"included in their application.\n"
+	"Using --squash also helps avoid problems when the same subproject\n"
+	"is included multiple times in the same project, or is removed and\n"
+	"then re-added. In such a case, it doesn’t make sense to combine the\n"
+	"histories anyway, since it’s unclear which part of the history\n"
+	"belongs to which subtree.\n"
+	"Furthermore, with --squash, you can switch back and forth between\n"
+	"different versions of a subtree, rather than strictly forward.  git\n"
+	"subtree merge --squash always adjusts the subtree to match the\n"
+	"exactly specified commit, even if getting to that commit would\n"
+	"require undoing some changes that were added earlier.\n"
+	"Whether or not you use --squash, changes made in your local\n"
+	"repository remain intact and can be later split and send upstream\n"
+	"to the subproject."
+)
+_HELP_MESSAGE = "Specify <message> as the commit message for the merge commit."
+_HELP_ANNOTATE = (
+	"When generating synthetic history, add <annotation> as a prefix to\n"
+	"each commit message. Since we’re creating new commits with the same\n"
+	"commit message, but possibly different content, from the original\n"
+	"commits, this can help to differentiate them and avoid confusion.\n"
+	"Whenever you split, you need to use the same <annotation>, or else\n"
+	"you don’t have a guarantee that the new re-created history will be\n"
+	"identical to the old one. That will prevent merging from working\n"
+	"correctly. git subtree tries to make it work anyway, particularly\n"
+	"if you use --rejoin, but it may not always be effective."
+)
+_HELP_BRANCH = (
+	"After generating the synthetic history, create a new branch called\n"
+	"<branch> that contains the new history. This is suitable for\n"
+	"immediate pushing upstream. <branch> must not already exist."
+)
+_HELP_IGNORE_JOINS = (
+	"If you use --rejoin, git subtree attempts to optimize its history\n"
+	"reconstruction to generate only the new commits since the last\n"
+	"--rejoin.  --ignore-joins disables this behavior, forcing it to\n"
+	"regenerate the entire history. In a large project, this can take a\n"
+	"long time."
+)
+_HELP_ONTO = (
+	"If your subtree was originally imported using something other than\n"
+	"git subtree, its history may not match what git subtree is\n"
+	"expecting. In that case, you can specify the commit ID <onto> that\n"
+	"corresponds to the first revision of the subproject’s history that\n"
+	"was imported into your project, and git subtree will attempt to\n"
+	"build its history from there.\n"
+	"If you used git subtree add, you should never need this option."
+)
+_HELP_REJOIN = (
+	"After splitting, merge the newly created synthetic history back\n"
+	"into your main project. That way, future splits can search only the\n"
+	"part of history that has been added since the most recent --rejoin.\n"
+	"If your split commits end up merged into the upstream subproject,\n"
+	"and then you want to get the latest upstream version, this will\n"
+	"allow git’s merge algorithm to more intelligently avoid conflicts\n"
+	"(since it knows these synthetic commits are already part of the\n"
+	"upstream repository).\n"
+	"Unfortunately, using this option results in git log showing an\n"
+	"extra copy of every new commit that was created (the original, and\n"
+	"the synthetic one).\n"
+	"If you do all your merges with --squash, make sure you also use\n"
+	"--squash when you split --rejoin."
+)
+"""The help texts of the command line options shared by several commands."""
+
+_HELP_ADD = (
+	"Create the <prefix> subtree by importing its contents from the given\n"
+	"<local-commit> or <repository> and <remote-ref>. A new commit is\n"
+	"created automatically, joining the imported project’s history with\n"
+	"your own. With --squash, import only a single commit from the\n"
+	"subproject, rather than its entire history."
+)
+_HELP_MERGE = (
+	"Merge recent changes up to <local-commit> into the <prefix>\n"
+	"subtree. As with normal git merge, this doesn’t remove your own\n"
+	"local changes; it just merges those changes into the latest\n"
+	"<local-commit>. With --squash, create only one commit that contains\n"
+	"all the changes, rather than merging in the entire history.\n"
+	"If you use --squash, the merge direction doesn’t always have to be\n"
+	"forward; you can use this command to go back in time from v2.5 to\n"
+	"v2.4, for example. If your merge introduces a conflict, you can\n"
+	"resolve it in the usual ways.\n"
+	"When using --squash, and the previous merge with --squash merged an\n"
+	"annotated tag of the subtree repository, that tag needs to be\n"
+	"available locally. If <repository> is given, a missing tag will\n"
+	"automatically be fetched from that repository."
+)
+_HELP_SPLIT = (
+	"Extract a new, synthetic project history from the history of the\n"
+	"<prefix> subtree of <local-commit>, or of HEAD if no <local-commit>\n"
+	"is given. The new history includes only the commits (including\n"
+	"merges) that affected <prefix>, and each of those commits now has\n"
+	"the contents of <prefix> at the root of the project instead of in a\n"
+	"subdirectory. Thus, the newly created history is suitable for\n"
+	"export as a separate git repository.\n"
+	"After splitting successfully, a single commit ID is printed to\n"
+	"stdout. This corresponds to the HEAD of the newly created tree,\n"
+	"which you can manipulate however you want.\n"
+	"Repeated splits of exactly the same history are guaranteed to be\n"
+	"identical (i.e. to produce the same commit IDs) as long as the\n"
+	"settings passed to split (such as --annotate) are the same. Because\n"
+	"of this, if you add new commits and then re-split, the new commits\n"
+	"will be attached as commits on top of the history you generated\n"
+	"last time, so git merge and friends will work as expected.\n"
+	"When a previous merge with --squash merged an annotated tag of the\n"
+	"subtree repository, that tag needs to be available locally. If\n"
+	"<repository> is given, a missing tag will automatically be fetched\n"
+	"from that repository."
+)
+_HELP_PULL = (
+	"Exactly like merge, but parallels git pull in that it fetches the\n"
+	"given ref from the specified remote repository."
+)
+_HELP_PUSH = (
+	"Does a split using the <prefix> subtree of <local-commit> and then\n"
+	"does a git push to push the result to the <repository> and\n"
+	"<remote-ref>. This can be used to push your subtree to different\n"
+	"branches of the remote repository. Just as with split, if no\n"
+	"<local-commit> is given, then HEAD is used. The optional leading +\n"
+	"is ignored."
+)
+"""The help texts of the commands."""
+
+
+_CLI_OPTIONS = {
+	"quiet": (("-q", "--quiet"), False, "Suppress unnecessary output messages on stderr."),
+	"debug": (("-d", "--debug"), False, "Produce even more unnecessary output messages on stderr."),
+	"prefix": (
+		("-P", "--prefix"), True,
+		"Specify the path in the repository to the subtree you want to manipulate. This option is mandatory for all "
+		"commands."
+	),
+	"squash": (("-s", "--squash"), False, _HELP_SQUASH),
+	"message": (("-m", "--message"), True, _HELP_MESSAGE),
+	"annotate": (("--annotate",), True, _HELP_ANNOTATE),
+	"branch": (("-b", "--branch"), True, _HELP_BRANCH),
+	"ignore_joins": (("--ignore-joins",), False, _HELP_IGNORE_JOINS),
+	"onto": (("--onto",), True, _HELP_ONTO),
+	"rejoin": (("--rejoin",), False, _HELP_REJOIN),
+}
+"""
+The options of the command line by their destination: their switches,
+whether they take a value, and their help. Both the argparse parsers
+and the tables of `_parse_arguments` are made from these.
+"""
+_CLI_GLOBAL_OPTIONS = ("quiet", "debug", "prefix")
+"""The options for all commands."""
+_CLI_SQUASH_OPTIONS = ("squash", "message")
+"""The options of the commands that merge into the project."""
+_CLI_SPLIT_OPTIONS = ("annotate", "branch", "ignore_joins", "onto", "rejoin")
+"""The options of the commands that split the subtree, besides those of the merge of --rejoin."""
+
+
+def _add_options(parser, destinations):
+	"""Add the options with the given `destinations` to the argparse `parser`."""
+	for destination in destinations:
+		switches, valued, text = _CLI_OPTIONS[destination]
+		if valued:
+			parser.add_argument(*switches, dest=destination, type=str, help=text)
+		else:
+			parser.add_argument(*switches, dest=destination, action="store_true", help=text)
+
+
+def _switches(*destinations) -> dict:
+	"""The options with the given `destinations`, by their switches."""
+	return {switch: destination for destination in destinations for switch in _CLI_OPTIONS[destination][0]}
+
+
+@functools.lru_cache(maxsize=1)
+def _squash_parent():
+	"""The parent parser with the options of the commands that merge into the project."""
 	import argparse
-	parser = argparse.ArgumentParser(description="Process git subtree commands.")
 
-	subparsers = parser.add_subparsers(dest="command", help="Subtree command to execute.")
+	parser = argparse.ArgumentParser(add_help=False)
+	_add_options(parser, _CLI_SQUASH_OPTIONS)
+	return parser
 
-	# region Commands and their arguments (not options)
-	# region Add
-	add = subparsers.add_parser(
-		"add",
-		help="Create the <prefix> subtree by importing its contents from the given <local-commit> or <repository> and "
-		"<remote-ref>. A new commit is created automatically, joining the imported project’s history with your own. "
-		"With --squash, import only a single commit from the subproject, rather than its entire history."
-	)
-	# hack to allow for mutually exclusive argument GROUPs, or in other words, overloading the add command.
-	add.add_argument("local-commit-or-repository", type=str)
-	add.add_argument("remote-ref", type=str, nargs="?")
-	# endregion Add
-
-	# region Merge
-	merge = subparsers.add_parser(
-		"merge",
-		help="Merge recent changes up to <local-commit> into the <prefix>"
-		"subtree. As with normal git merge, this doesn’t remove your own"
-		"local changes; it just merges those changes into the latest"
-		"<local-commit>. With --squash, create only one commit that contains"
-		"all the changes, rather than merging in the entire history."
-		"\n"
-		"If you use --squash, the merge direction doesn’t always have to be"
-		"forward; you can use this command to go back in time from v2.5 to"
-		"v2.4, for example. If your merge introduces a conflict, you can"
-		"resolve it in the usual ways."
-		"\n"
-		"When using --squash, and the previous merge with --squash merged an"
-		"annotated tag of the subtree repository, that tag needs to be"
-		"available locally. If <repository> is given, a missing tag will"
-		"automatically be fetched from that repository."
-	)
-	merge.add_argument("local-commit", type=str)
-	merge.add_argument("repository", type=str, nargs="?")
-	# endregion Merge
-
-	# region Split
-	split = subparsers.add_parser(
-		"split",
-		help="Extract a new, synthetic project history from the history of the"
-		"<prefix> subtree of <local-commit>, or of HEAD if no <local-commit>"
-		"is given. The new history includes only the commits (including"
-		"merges) that affected <prefix>, and each of those commits now has"
-		"the contents of <prefix> at the root of the project instead of in a"
-		"subdirectory. Thus, the newly created history is suitable for"
-		"export as a separate git repository."
-		"\n"
-		"After splitting successfully, a single commit ID is printed to"
-		"stdout. This corresponds to the HEAD of the newly created tree,"
-		"which you can manipulate however you want."
-		"\n"
-		"Repeated splits of exactly the same history are guaranteed to be"
-		"identical (i.e. to produce the same commit IDs) as long as the"
-		"settings passed to split (such as --annotate) are the same. Because"
-		"of this, if you add new commits and then re-split, the new commits"
-		"will be attached as commits on top of the history you generated"
-		"last time, so git merge and friends will work as expected."
-		"\n"
-		"When a previous merge with --squash merged an annotated tag of the"
-		"subtree repository, that tag needs to be available locally. If"
-		"<repository> is given, a missing tag will automatically be fetched"
-		"from that repository."
-	)
-	split.add_argument("local-commit", type=str, nargs="?")
-	split.add_argument("repository", type=str, nargs="?")
-	# endregion Split
-
-	# region Pull
-	pull = subparsers.add_parser(
-		"pull",
-		help="Exactly like merge, but parallels git pull in that it fetches the"
-		"given ref from the specified remote repository."
+
+@functools.lru_cache(maxsize=1)
+def _split_parent():
+	"""The parent parser with the options of the commands that split the subtree, and merge it back with --rejoin."""
+	import argparse
+
+	parser = argparse.ArgumentParser(add_help=False, parents=[_squash_parent()])
+	_add_options(parser, _CLI_SPLIT_OPTIONS)
+	return parser
+
+
+_CLI_GLOBAL = _switches(*_CLI_GLOBAL_OPTIONS)
+"""The options for all commands, by their switches."""
+_CLI_SQUASH = _switches(*_CLI_SQUASH_OPTIONS)
+"""The options of the commands that merge into the project, by their switches."""
+_CLI_SPLIT = _switches(*_CLI_SQUASH_OPTIONS, *_CLI_SPLIT_OPTIONS)
+"""The options of the commands that split the subtree, by their switches."""
+_CLI_VALUED = frozenset(destination for destination, (_, valued, _) in _CLI_OPTIONS.items() if valued)
+"""The options that take a value, by their destination."""
+_SUBCOMMANDS = {
+	"add": {
+		"help": _HELP_ADD,
+		"parents": (_squash_parent,),
+		"switches": _CLI_SQUASH,
+		# hack to allow for mutually exclusive argument GROUPs, or in other words, overloading the add command.
+		"arguments": (
+			("local_commit_or_repository", {"metavar": "local-commit-or-repository"}),
+			("remote_ref", {"metavar": "remote-ref", "nargs": "?"}),
+		),
+	},
+	"merge": {
+		"help": _HELP_MERGE,
+		"parents": (_squash_parent,),
+		"switches": _CLI_SQUASH,
+		"arguments": (("local_commit", {"metavar": "local-commit"}), ("repository", {"nargs": "?"})),
+	},
+	"split": {
+		"help": _HELP_SPLIT,
+		"parents": (_split_parent,),
+		"switches": _CLI_SPLIT,
+		"arguments": (("local_commit", {"metavar": "local-commit", "nargs": "?"}), ("repository", {"nargs": "?"})),
+	},
+	"pull": {
+		"help": _HELP_PULL,
+		"parents": (),
+		"switches": {},
+		"arguments": (("repository", {}), ("remote_ref", {"metavar": "remote-ref"})),
+	},
+	"push": {
+		"help": _HELP_PUSH,
+		"parents": (_split_parent,),
+		"switches": _CLI_SPLIT,
+		"arguments": (("repository", {}), ("refspec", {"metavar": "[+][<local-commit>]<remote-ref>"})),
+	},
+}
+"""
+For each command, its help text, the functions returning the parent parsers
+with its options, its options by their switches, and its positional
+arguments with the keyword arguments of their `add_argument`.
+"""
+
+_COMMANDS = tuple(_SUBCOMMANDS)
+"""The commands of the command line."""
+
+_HELP = {}
+"""The help of the command line (under None) and of its commands, once formatted."""
+
+
+def _help(command=None):
+	"""The help of `command`, or of the whole command line if `command` is None."""
+	text = _HELP.get(command)
+	if text is None:
+		text = _HELP[command] = (_build_parser() if command is None else _command_parser(command)).format_help()
+	return text
+
+
+def _completion(shell):
+	"""
+	A completion script of the command line for `shell`, which completes
+	the commands and options without running python.
+	:param shell: bash, zsh or fish.
+	"""
+	program = os.path.basename(sys.argv[0])
+	function = "_" + re.sub(r"\W", "_", program)
+	commands = " ".join(_COMMANDS)
+	switches = {**{command: _SUBCOMMANDS[command]["switches"] for command in _COMMANDS}, None: _CLI_GLOBAL}
+
+	if shell == "fish":
+		lines = [f'complete -c {program} -f -n "not __fish_seen_subcommand_from {commands}" -a "{commands}"']
+		for command, options in switches.items():
+			if command is None:
+				condition = f"not __fish_seen_subcommand_from {commands}"
+			else:
+				condition = f"__fish_seen_subcommand_from {command}"
+			for destination in dict.fromkeys(options.values()):
+				line = f'complete -c {program} -n "{condition}"'
+				for switch, option in options.items():
+					if option == destination:
+						line += f" -l {switch[2:]}" if switch.startswith("--") else f" -s {switch[1:]}"
+				lines.append(line + (" -r" if destination in _CLI_VALUED else ""))
+		return "\n".join(lines) + "\n"
+
+	if shell == "bash":
+		words, complete = '"${COMP_WORDS[@]:1:COMP_CWORD-1}"', 'COMPREPLY=($(compgen -W "{}" -- "${{COMP_WORDS[COMP_CWORD]}}"))'
+		header, footer = "", f"complete -o default -F {function} {program}\n"
+	elif shell == "zsh":
+		words, complete = "${words[2,CURRENT-1]}", "compadd -- {}"
+		header, footer = f"#compdef {program}\n", f"compdef {function} {program}\n"
+	else:
+		raise ValueError(f"Unknown shell {shell!r}.")
+	cases = ""
+	for command, options in switches.items():
+		completions = " ".join(("-h", "--help", *options, *(_COMMANDS if command is None else ())))
+		cases += f"\t\t{command or '*'}) {complete.format(completions)};;\n"
+	return (
+		f"{header}{function}() {{\n"
+		"\tlocal command word\n"
+		f"\tfor word in {words}; do\n"
+		f"\t\tcase $word in {'|'.join(_COMMANDS)}) command=$word; break;; esac\n"
+		"\tdone\n"
+		f"\tcase $command in\n{cases}\tesac\n"
+		f"}}\n{footer}"
 	)
-	pull.add_argument("repository", type=str)
-	pull.add_argument("remote-ref", type=str)
-	# endregion Pull
-
-	# region Push
-	push = subparsers.add_parser(
-		"push",
-		help="Does a split using the <prefix> subtree of <local-commit> and then"
-		"does a git push to push the result to the <repository> and"
-		"<remote-ref>. This can be used to push your subtree to different"
-		"branches of the remote repository. Just as with split, if no"
-		"<local-commit> is given, then HEAD is used. The optional leading +"
-		"is ignored."
+
+
+class _Arguments:
+	"""The parsed command line arguments, with a slot for each argument the parsers have."""
+
+	__slots__ = (
+		"command", "quiet", "debug", "prefix", "emit_completion", "arguments",
+		"local_commit_or_repository", "local_commit", "repository", "remote_ref", "refspec",
+		"squash", "message", "annotate", "branch", "ignore_joins", "onto", "rejoin",
 	)
-	push.add_argument("repository", type=str)
-	push.add_argument("[+][<local-commit>]<remote-ref>", type=str)
-	# endregion Push
 
-	# endregion Commands and their arguments (not options)
+	def __init__(self, **arguments):
+		for name, value in arguments.items():
+			setattr(self, name, value)
 
-	# region Options
-	# region For all commands
-	parser.add_argument(
-		"-q", "--quiet", action="store_true",
-		help="Suppress unnecessary output messages on stderr."
+	def items(self):
+		"""The (name, value) pairs of the arguments that were parsed."""
+		return [(name, getattr(self, name)) for name in self.__slots__ if hasattr(self, name)]
+
+
+def _parse_arguments(arguments):
+	"""
+	Parse the command line `arguments` like the parser of `_build_parser` does, without building it.
+	:return: The parsed arguments, or None for anything out of the ordinary, like asking for help,
+		mistakes or `--`, which is left to the parser.
+	"""
+	parsed = _Arguments(command=None, quiet=False, debug=False, prefix=None, emit_completion=None)
+	switches, positionals = _CLI_GLOBAL, ()
+	values = []
+	arguments = iter(arguments)
+	for argument in arguments:
+		if argument.startswith("-") and argument != "-":
+			switch, equals, value = argument.partition("=") if argument.startswith("--") else (argument, "", "")
+			destination = switches.get(switch)
+			if destination is None:
+				return None
+			if destination not in _CLI_VALUED:
+				if equals:
+					return None
+				value = True
+			elif not equals:
+				value = next(arguments, None)
+				if value is None or value.startswith("-"):
+					return None
+			setattr(parsed, destination, value)
+		elif parsed.command is None:
+			if argument not in _SUBCOMMANDS:
+				return None
+			parsed.command = argument
+			switches, positionals = _SUBCOMMANDS[argument]["switches"], _SUBCOMMANDS[argument]["arguments"]
+			for destination in switches.values():  # the defaults argparse sets
+				setattr(parsed, destination, None if destination in _CLI_VALUED else False)
+		else:
+			values.append(argument)
+
+	if parsed.command is None:
+		return None
+	required = sum("nargs" not in options for _, options in positionals)
+	if not required <= len(values) <= len(positionals):
+		return None
+	for index, (positional, _) in enumerate(positionals):
+		setattr(parsed, positional, values[index] if index < len(values) else None)
+	return parsed
+
+
+@functools.lru_cache(maxsize=256)
+def _split_lines(text, width):
+	"""The lines of the help `text`, wrapped to `width` like argparse does it."""
+	import textwrap
+
+	return tuple(textwrap.wrap(re.sub(r"\s+", " ", text, flags=re.ASCII).strip(), width))
+
+
+@functools.lru_cache(maxsize=1)
+def _help_formatter():
+	"""The help formatter class of the parsers, which wraps each help text only once for every width."""
+	import argparse
+
+	class CachedHelpFormatter(argparse.HelpFormatter):
+		def _split_lines(self, text, width):
+			return list(_split_lines(text, width))
+
+	return CachedHelpFormatter
+
+
+@functools.lru_cache(maxsize=1)
+def _build_parser():
+	"""Build the parser of the options for all commands once, and return the same one for every later call."""
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description="Process git subtree commands.", formatter_class=_help_formatter(), allow_abbrev=False
 	)
+	_add_options(parser, _CLI_GLOBAL_OPTIONS)
+	# not a git subtree option, so it is left to argparse, as is everything without a command
 	parser.add_argument(
-		"-d", "--debug", action="store_true",
-		help="Produce even more unnecessary output messages on stderr."
+		"--emit-completion", choices=("bash", "zsh", "fish"), metavar="SHELL",
+		help="Print a completion script for SHELL (bash, zsh or fish) and exit, for example to save in "
+		"/etc/bash_completion.d/."
 	)
+	parser.add_argument("command", nargs="?", choices=_COMMANDS, help="Subtree command to execute.")
 	parser.add_argument(
-		"-P", "--prefix", type=str,
-		help="Specify the path in the repository to the subtree you want to manipulate. This option is mandatory for all"
-		"commands."
+		"arguments", nargs=argparse.REMAINDER, metavar="...",
+		help="The arguments and options of the command, see its help with <command> -h."
 	)
-	# endregion For all commands
-
-	# region Add, merge, split --rejoing, push --rejoin
-	commands = [add, merge]
-	for command in [split, push]:
-		# TODO: Only add these to the array if --rejoin somehow
-		commands.append(command)
-
-	for command in commands:
-		command.add_argument(
-			"-s", "--squash", action="store_true",
-			help="Instead of merging the entire history from the subtree project,"
-			"produce only a single commit that contains all the differences you"
-			"want to merge, and then merge that new commit into your project."
-			"\n"
-			"Using this option helps to reduce log clutter. People rarely want"
-			"to see every change that happened between v1.0 and v1.1 of the"
-			"library they’re using, since none of the interim versions were ever"
-			"included in their application."
-			"\n"
-			"Using --squash also helps avoid problems when the same subproject"
-			"is included multiple times in the same project, or is removed and"
-			"then re-added. In such a case, it doesn’t make sense to combine the"
-			"histories anyway, since it’s unclear which part of the history"
-			"belongs to which subtree."
-			"\n"
-			"Furthermore, with --squash, you can switch back and forth between"
-			"different versions of a subtree, rather than strictly forward.  git"
-			"subtree merge --squash always adjusts the subtree to match the"
-			"exactly specified commit, even if getting to that commit would"
-			"require undoing some changes that were added earlier."
-			"\n"
-			"Whether or not you use --squash, changes made in your local"
-			"repository remain intact and can be later split and send upstream"
-			"to the subproject."
-		)
-		command.add_argument(
-			"-m", "--message", type=str,
-			help="Specify <message> as the commit message for the merge commit."
-		)
-	# endregion Add, merge, split --rejoing, push --rejoin
-
-	for command in [split, push]:
-		command.add_argument(
-			"--annotate", type=str,
-			help="When generating synthetic history, add <annotation> as a prefix to"
-			"each commit message. Since we’re creating new commits with the same"
-			"commit message, but possibly different content, from the original"
-			"commits, this can help to differentiate them and avoid confusion."
-			"\n"
-			"Whenever you split, you need to use the same <annotation>, or else"
-			"you don’t have a guarantee that the new re-created history will be"
-			"identical to the old one. That will prevent merging from working"
-			"correctly. git subtree tries to make it work anyway, particularly"
-			"if you use --rejoin, but it may not always be effective."
-		)
-		command.add_argument(
-			"-b", "--branch", type=str,
-			help="After generating the synthetic history, create a new branch called"
-			"<branch> that contains the new history. This is suitable for"
-			"immediate pushing upstream. <branch> must not already exist."
-		)
-		command.add_argument(
-			"--ignore-joins", action="store_true",
-			help="If you use --rejoin, git subtree attempts to optimize its history"
-			"reconstruction to generate only the new commits since the last"
-			"--rejoin.  --ignore-joins disables this behavior, forcing it to"
-			"regenerate the entire history. In a large project, this can take a"
-			"long time."
-		)
-		command.add_argument(
-			"--onto", type=str,
-			help="If your subtree was originally imported using something other than"
-			"git subtree, its history may not match what git subtree is"
-			"expecting. In that case, you can specify the commit ID <onto> that"
-			"corresponds to the first revision of the subproject’s history that"
-			"was imported into your project, and git subtree will attempt to"
-			"build its history from there."
-			"\n"
-			"If you used git subtree add, you should never need this option."
-		)
-		command.add_argument(
-			"--rejoin", action="store_true",
-			help=" After splitting, merge the newly created synthetic history back"
-			"into your main project. That way, future splits can search only the"
-			"part of history that has been added since the most recent --rejoin."
-			"\n"
-			"If your split commits end up merged into the upstream subproject,"
-			"and then you want to get the latest upstream version, this will"
-			"allow git’s merge algorithm to more intelligently avoid conflicts"
-			"(since it knows these synthetic commits are already part of the"
-			"upstream repository)."
-			"\n"
-			"Unfortunately, using this option results in git log showing an"
-			"extra copy of every new commit that was created (the original, and"
-			"the synthetic one)."
-			"\n"
-			"If you do all your merges with --squash, make sure you also use"
-			"--squash when you split --rejoin."
-		)
+	return parser
+
+
+@functools.lru_cache(maxsize=None)
+def _command_parser(command):
+	"""Build the parser of the arguments and options of `command` once, and return the same one for every later call."""
+	import argparse
+
+	subcommand = _SUBCOMMANDS[command]
+	parser = argparse.ArgumentParser(
+		prog=f"{_build_parser().prog} {command}", description=subcommand["help"],
+		parents=[parent() for parent in subcommand["parents"]], formatter_class=_help_formatter(), allow_abbrev=False
+	)
+	for name, options in subcommand["arguments"]:
+		parser.add_argument(name, type=str, **options)
+	return parser
 
-	# endregion Options
 
-	args = parser.parse_args()
-	# endregion Parse command line arguments
+def _parse_command_line(arguments):
+	"""
+	Parse the command line `arguments` with argparse, the options for all commands first and then those of the command.
+	This also answers asking for help, and reports mistakes.
+	"""
+	parsed = _build_parser().parse_args(arguments, _Arguments())
+	arguments = parsed.arguments
+	del parsed.arguments
+	if parsed.command is not None:
+		_command_parser(parsed.command).parse_args(arguments, parsed)
+	return parsed
+
+
+def _cli():
+	"""Run the `git-subtree` command given on the command line in the current directory."""
+	# asking for help is answered right away, without parsing the command line
+	arguments = sys.argv[1:]
+	if 1 <= len(arguments) <= 2 and arguments[-1] in ("-h", "--help"):
+		if len(arguments) == 1 or arguments[0] in _COMMANDS:
+			sys.stdout.write(_help(arguments[0] if len(arguments) == 2 else None))
+			return
+
+	args = _parse_arguments(arguments) or _parse_command_line(arguments)
+	if getattr(args, "emit_completion", None) is not None:
+		sys.stdout.write(_completion(args.emit_completion))
+		return
 
 	def fail():
-		parser.print_help()
+		sys.stdout.write(_help())
 		exit(1)
 
 	self = GitSubtree(repository_path=".", prefix=args.prefix, quiet=args.quiet, debug=args.debug)
@@ -916,14 +1976,24 @@ if __name__ == "__main__":
 		fail()
 
 	function_args_dict = {}
-	for key, value in vars(args).items():
-		if value is not None and key not in ["command", "quiet", "debug", "prefix"]:
-			function_args_dict[key.replace("-", "_").lower()] = value
+	for key, value in args.items():
+		if value is not None and key not in ["command", "quiet", "debug", "prefix", "emit_completion"]:
+			function_args_dict[key] = value
 
 	if args.command == "add":
 		# decide which overload of the add command to use
 		function_args_dict[
 			"repository" if "remote_ref" in function_args_dict else "local_commit"
 		] = function_args_dict.pop("local_commit_or_repository")
+	elif args.command == "push":
+		# the local commit and the remote ref share an argument, like in a git push refspec
+		local_commit, _, remote_ref = function_args_dict.pop("refspec").lstrip("+").rpartition(":")
+		function_args_dict.update(local_commit=local_commit or None, remote_ref=remote_ref)
+
+	result = function(self, **function_args_dict)
+	if args.command == "split" and result is not None:
+		print(result)  # like git subtree split, the commit ID is its output
 
-	function(self, **function_args_dict)
+
+if __name__ == "__main__":
+	_cli()
@@ -0,0 +1,421 @@
+import os
+import signal
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import git_subtree
+from git_subtree import GitSubtree
+
+_ENVIRONMENT = {
+	"GIT_AUTHOR_NAME": "Author",
+	"GIT_AUTHOR_EMAIL": "author@example.com",
+	"GIT_AUTHOR_DATE": "1700000000 +0000",
+	"GIT_COMMITTER_NAME": "Committer",
+	"GIT_COMMITTER_EMAIL": "committer@example.com",
+	"GIT_COMMITTER_DATE": "1700000000 +0000",
+	"GIT_CONFIG_GLOBAL": os.devnull,
+	"GIT_CONFIG_NOSYSTEM": "1",
+}
+"""A fixed identity and time, so that the same commands create the same commit IDs, and no user configuration."""
+
+
+def setUpModule():
+	os.environ.update(_ENVIRONMENT)
+
+
+def git(directory: str, *args) -> str:
+	"""Run git in `directory` and return its stripped stdout."""
+	return subprocess.run(
+		[git_subtree._GIT, *args], cwd=directory, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+	).stdout.decode().strip()
+
+
+def commit(directory: str, message: str, **files) -> str:
+	"""Write the `files`, by their path with / written as __, commit them all and return the commit ID."""
+	for path, content in files.items():
+		path = os.path.join(directory, *path.split("__"))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "a") as file:
+			file.write(content)
+	git(directory, "add", "-A")
+	git(directory, "commit", "-q", "-m", message)
+	return git(directory, "rev-parse", "HEAD")
+
+
+def repository(directory: str) -> str:
+	"""Create an empty repository at `directory` and return its path."""
+	git(os.path.dirname(directory), "init", "-q", "-b", "main", directory)
+	return directory
+
+
+class TestHelper(unittest.TestCase):
+	"""A command run by a helper shell has to give the exit status and stdout it would give on its own."""
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def run_command(self, *args) -> tuple:
+		return git_subtree._POOL.run(git_subtree._Helper.command_line(args), self.directory.name)
+
+	def test_quoting(self):
+		text = "line one\n\n  it's \"quoted\" $HOME `true` \\n\t'\"$nl\"'\n"
+		self.assertEqual(self.run_command("printf", "%s", text), (0, text.encode()))
+
+	def test_exit_status(self):
+		self.assertEqual(self.run_command("sh", "-c", "printf out; exit 3"), (3, b"out"))
+		self.assertEqual(self.run_command("true"), (0, b""))
+
+	def test_no_trailing_newline(self):
+		self.assertEqual(self.run_command("printf", "%s", "no newline"), (0, b"no newline"))
+		self.assertEqual(self.run_command("printf", "%s", "\n\n"), (0, b"\n\n"))
+
+	def test_large_output(self):
+		text = "0123456789abcdef" * (git_subtree._BUFFER_SIZE // 4)  # read in several chunks
+		self.assertEqual(self.run_command("printf", "%s", text), (0, text.encode()))
+
+	def test_capture(self):
+		line = git_subtree._Helper.command_line(("printf", "%s", "discarded"), capture=False)
+		self.assertEqual(git_subtree._POOL.run(line, self.directory.name), (0, b""))
+
+
+class TestWorkerPool(unittest.TestCase):
+	"""The helper shells shared by all instances have to give each command its own output, whatever happens to them."""
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.subtree = GitSubtree(repository(os.path.join(self.directory.name, "project")), prefix="library")
+		self.git_dir = self.subtree._git("rev-parse", "--absolute-git-dir")
+
+	def tearDown(self):
+		GitSubtree.shutdown_pool()
+		self.directory.cleanup()
+
+	@unittest.skipUnless(hasattr(os, "fork"), "no os.fork")
+	def test_fork(self):
+		size = git_subtree._POOL.size
+		git_subtree._POOL.size = 1  # parent and child would share the one shell
+		self.addCleanup(setattr, git_subtree._POOL, "size", size)
+		self.subtree._object_exists("0" * 40)  # start the cat-file process as well
+		pid = os.fork()
+		if pid == 0:
+			passed = all(self.subtree._git("rev-parse", "--absolute-git-dir") == self.git_dir for _ in range(100))
+			os._exit(0 if passed else 1)
+		for _ in range(100):
+			self.assertEqual(self.subtree._git("rev-parse", "--absolute-git-dir"), self.git_dir)
+		self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+	def kill_idle(self) -> list:
+		"""Interrupt the idle helper shells like a Ctrl-C would, wait for them to exit and return them."""
+		workers = list(git_subtree._POOL.idle)
+		for worker in workers:
+			os.kill(worker.process.pid, signal.SIGINT)
+			os.waitid(os.P_PID, worker.process.pid, os.WEXITED | os.WNOWAIT)
+		return workers
+
+	def test_dead_helper(self):
+		self.assertTrue(self.kill_idle())
+		self.assertEqual(self.subtree._git("rev-parse", "--absolute-git-dir"), self.git_dir)
+
+	def test_dead_helper_unnoticed(self):
+		for worker in self.kill_idle():
+			worker.process.poll = lambda: None  # exited right after it was taken from the pool
+		self.assertEqual(self.subtree._git("rev-parse", "--absolute-git-dir"), self.git_dir)
+
+	def test_environment(self):
+		self.assertTrue(self.subtree._git("var", "GIT_COMMITTER_IDENT")[1].startswith(b"Committer <"))
+		with mock.patch.dict(os.environ, GIT_COMMITTER_NAME="Changed"):
+			self.assertTrue(self.subtree._git("var", "GIT_COMMITTER_IDENT")[1].startswith(b"Changed <"))
+		self.assertTrue(self.subtree._git("var", "GIT_COMMITTER_IDENT")[1].startswith(b"Committer <"))
+
+
+class TestCommandLine(unittest.TestCase):
+	"""The fast command line parser has to give the same arguments as argparse, or leave the command line to it."""
+
+	def test_same_as_argparse(self):
+		for arguments in (
+			["--prefix=x", "split"],
+			["-P", "x", "split", "--annotate=(x) ", "--onto", "o", "--ignore-joins", "HEAD", "repository"],
+			["-q", "-d", "-P", "x", "split", "--rejoin", "-b", "branch", "-s", "-m", "message"],
+			["-P", "x", "add", "--message=", "repository", "ref"],
+			["-P", "x", "add", "-s", "-"],
+			["-P", "x", "merge", "--squash", "--message=m", "commit", "repository"],
+			["-P", "x", "pull", "repository", "ref"],
+			["-P", "x", "push", "up", "+a:b"],
+			["--quiet", "--debug", "--prefix", "x", "push", "--branch=b", "up", "b"],
+		):
+			with self.subTest(arguments=arguments):
+				parsed = git_subtree._parse_arguments(arguments)
+				self.assertIsNotNone(parsed)
+				self.assertEqual(parsed.items(), git_subtree._parse_command_line(arguments).items())
+
+	def test_left_to_argparse(self):
+		for arguments in (
+			[],
+			["-P", "x", "split", "--", "HEAD"],
+			["-qd", "-P", "x", "split"],
+			["split", "-P", "x"],
+			["-P", "x", "merge", "-m", "-x", "commit"],
+			["-P", "x", "split", "-h"],
+			["-P", "x", "split", "--rejoin=yes"],
+			["-P", "x", "pull", "repository"],
+			["-P", "x", "split", "a", "b", "c"],
+			["-P", "x", "fetch"],
+			["--emit-completion", "bash"],
+		):
+			with self.subTest(arguments=arguments):
+				self.assertIsNone(git_subtree._parse_arguments(arguments))
+
+
+class TestBatch(unittest.TestCase):
+	"""Commands collected by `batch` have to run in order, until the first one that fails."""
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.library = repository(os.path.join(self.directory.name, "library"))
+		commit(self.library, "library one", a="one\n")
+		self.project = repository(os.path.join(self.directory.name, "project"))
+		commit(self.project, "project", m="m\n")
+		git(self.project, "subtree", "add", "-q", "-P", "library", self.library, "main")
+		self.subtree = GitSubtree(self.project, prefix="library", quiet=True)
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_batch(self):
+		expected = git(self.project, "subtree", "split", "-q", "-P", "library")
+		annotated = git(self.project, "subtree", "split", "-q", "-P", "library", "--annotate", "(library) ")
+		with self.subtree.batch() as batch:
+			self.assertIsNone(self.subtree.split())
+			self.assertIsNone(self.subtree.split(annotate="(library) "))
+		self.assertEqual(batch.result.returncode, 0)
+		self.assertEqual(batch.result.stdout.decode().split(), [expected, annotated])
+		self.assertEqual(len(batch.result.args), 2)
+
+	def test_batch_failure(self):
+		head = git(self.project, "rev-parse", "HEAD")
+		commit(self.library, "library two", a="two\n")
+		with self.subtree.batch() as batch:
+			self.subtree.split("no such commit")
+			self.subtree.pull(self.library, "main")
+		self.assertNotEqual(batch.result.returncode, 0)
+		self.assertEqual(git(self.project, "rev-parse", "HEAD"), head)  # the pull didn't run
+
+
+class TestPipeline(unittest.TestCase):
+	"""A pipeline has to give a result for every call, while skipping the work its calls share."""
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.library = repository(os.path.join(self.directory.name, "library"))
+		commit(self.library, "library one", a="one\n")
+		self.project = repository(os.path.join(self.directory.name, "project"))
+		commit(self.project, "project", m="m\n")
+		git(self.project, "subtree", "add", "-q", "-P", "one", self.library, "main")
+		self.subtree = GitSubtree(self.project, prefix="one", quiet=True)
+		fetch = GitSubtree._fetch
+		self.fetch = mock.patch.object(GitSubtree, "_fetch", autospec=True, side_effect=fetch).start()
+		self.addCleanup(mock.patch.stopall)
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_split_push(self):
+		remote = os.path.join(self.directory.name, "remote")
+		git(self.directory.name, "init", "-q", "--bare", remote)
+		with self.subtree.pipeline() as pipeline:
+			pipeline.split(annotate="(one) ")
+			pipeline.push(remote, remote_ref="main", annotate="(one) ")
+			pipeline.split()
+		self.assertEqual(len(pipeline.results), 3)
+		self.assertIsNone(pipeline.results[0])  # done by the push
+		self.assertEqual(pipeline.results[1].returncode, 0)
+		self.assertEqual(pipeline.results[2], git(self.project, "subtree", "split", "-q", "-P", "one"))
+		annotated = git(self.project, "subtree", "split", "-q", "-P", "one", "--annotate", "(one) ")
+		self.assertEqual(git(remote, "rev-parse", "main"), annotated)
+
+	def test_shared_fetch(self):
+		with self.subtree.pipeline() as pipeline:
+			for prefix in ("two", "three"):
+				self.subtree.prefix = prefix
+				pipeline.add(self.library, "main")
+		self.assertEqual([result.returncode for result in pipeline.results], [0, 0])
+		self.assertEqual(self.fetch.call_count, 1)
+		for prefix in ("two", "three"):
+			with open(os.path.join(self.project, prefix, "a")) as file:
+				self.assertEqual(file.read(), "one\n")
+
+	def test_shared_pull(self):
+		commit(self.library, "library two", a="two\n")
+		with self.subtree.pipeline() as pipeline:
+			pipeline.pull(self.library, "main")
+			pipeline.pull(self.library, "main")
+		self.assertEqual([result.returncode for result in pipeline.results], [0, 0])
+		self.assertEqual(self.fetch.call_count, 1)
+		with open(os.path.join(self.project, "one", "a")) as file:
+			self.assertEqual(file.read(), "one\ntwo\n")
+
+	def test_pull_fetches(self):
+		self.subtree.pull(self.library, "main")
+		commit(self.library, "library two", a="two\n")
+		self.subtree.pull(self.library, "main")
+		self.assertEqual(self.fetch.call_count, 2)  # outside a pipeline, every pull fetches
+		with open(os.path.join(self.project, "one", "a")) as file:
+			self.assertEqual(file.read(), "one\ntwo\n")
+
+
+class TestFastAdd(unittest.TestCase):
+	"""`add` of a local commit, done with git plumbing, has to create the same commits as `git subtree add`."""
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.library = repository(os.path.join(self.directory.name, "library"))
+		commit(self.library, "library one", a="one\n")
+		self.commit = commit(self.library, "library two", a="two\n", sub__b="b\n")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def project(self) -> str:
+		"""A new project with a commit of its own and the library's commits fetched."""
+		project = repository(tempfile.mkdtemp(dir=self.directory.name))
+		commit(project, "project", m="m\n")
+		git(project, "fetch", "-q", self.library, "main")
+		return project
+
+	def assertSameAdd(self, prefix: str, squash: bool = False, message: str = None):
+		expected, actual = self.project(), self.project()
+		options = [*(["--squash"] if squash else []), *(["-m", message] if message else [])]
+		git(expected, "subtree", "add", "-q", "-P", prefix, *options, self.commit)
+		result = GitSubtree(actual, prefix=prefix, quiet=True).add(local_commit=self.commit, squash=squash, message=message)
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(git(actual, "rev-parse", "HEAD"), git(expected, "rev-parse", "HEAD"))
+		self.assertEqual(git(actual, "status", "--porcelain"), "")  # checked out like git subtree does
+
+	def test_add(self):
+		self.assertSameAdd("library")
+
+	def test_add_nested_prefix(self):
+		self.assertSameAdd("deep/er/library/")
+
+	def test_add_squash(self):
+		self.assertSameAdd("library", squash=True)
+
+	def test_add_message(self):
+		self.assertSameAdd("library", message="Import the library\n\nwith a body")
+		self.assertSameAdd("library", squash=True, message="Import the library squashed")
+
+
+class TestSplitCache(unittest.TestCase):
+	"""Cached splits have to be those `git subtree split` would create now."""
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		library = repository(os.path.join(self.directory.name, "library"))
+		commit(library, "library one", a="one\n")
+		self.project = repository(os.path.join(self.directory.name, "project"))
+		commit(self.project, "project", m="m\n")
+		# imported without git subtree, which is where --onto is needed
+		git(self.project, "fetch", "-q", library, "main:library")
+		git(self.project, "merge", "-q", "-s", "ours", "--no-commit", "--allow-unrelated-histories", "library")
+		git(self.project, "read-tree", "--prefix=library", "-u", "library")
+		git(self.project, "commit", "-q", "-m", "Import the library")
+		commit(self.project, "library two", library__a="two\n")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_onto_moved(self):
+		subtree = GitSubtree(self.project, prefix="library", quiet=True)
+		for base in ("library", "main~1"):
+			git(self.project, "branch", "-f", "base", base)
+			expected = git(self.project, "subtree", "split", "-q", "-P", "library", "--onto", "base")
+			self.assertEqual(subtree.split(onto="base"), expected)
+
+	def test_command(self):
+		GitSubtree(self.project, prefix="library", quiet=True).split()
+		head = git(self.project, "rev-parse", "HEAD")
+		other = GitSubtree(self.project, ("sh", "-c", f"echo {head}", "sh"), prefix="library", quiet=True)
+		self.assertEqual(other.split(), head)
+
+
+@unittest.skipIf(git_subtree.pygit2 is None, "pygit2 is not installed")
+class TestPygit2Split(unittest.TestCase):
+	"""The pygit2 backend's `split` has to create the same commits as `git subtree split`."""
+
+	@classmethod
+	def setUpClass(cls):
+		cls.directory = tempfile.TemporaryDirectory()
+		library = repository(os.path.join(cls.directory.name, "library"))
+		cls.library_root = commit(library, "library one", a="one\n")
+		commit(library, "library two", a="two\n")
+		cls.project = project = repository(os.path.join(cls.directory.name, "project"))
+		commit(project, "project", m="m\n")
+		git(project, "subtree", "add", "-q", "-P", "library", library, "main")
+		git(project, "subtree", "add", "-q", "-P", "deep/squashed", library, "main", "--squash")
+		for index in range(3):
+			commit(project, f"both {index}\n\nwith a body", library__a=f"{index}\n", m=f"{index}\n")
+			commit(project, f"squashed {index}", deep__squashed__a=f"{index}\n")
+		# a merge of a side branch touching the subtree
+		git(project, "checkout", "-q", "-b", "side", "HEAD~3")
+		commit(project, "side library", library__s="s\n")
+		commit(project, "side project", n="n\n")
+		git(project, "checkout", "-q", "main")
+		git(project, "merge", "-q", "--no-edit", "side")
+		git(project, "subtree", "split", "-q", "-P", "library", "--rejoin")
+		commit(project, "after the rejoin", library__a="z\n")
+		# a message git keeps verbatim, with leading blank lines
+		with open(os.path.join(project, "library", "a.txt"), "a") as file:
+			file.write("y\n")
+		git(project, "add", "-A")
+		tree = git(project, "write-tree")
+		message = subprocess.run(
+			[git_subtree._GIT, "commit-tree", tree, "-p", "HEAD"], cwd=project, check=True,
+			input=b"\n\nweird\n\n\nmessage  \n\n", stdout=subprocess.PIPE
+		).stdout.decode().strip()
+		git(project, "reset", "-q", "--hard", message)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.directory.cleanup()
+
+	def assertSameSplit(self, prefix: str, **options):
+		subtree = GitSubtree(self.project, prefix=prefix, quiet=True, backend="pygit2")
+		actual = subtree._pygit2_split(**options)
+		self.assertIsNotNone(actual, "pygit2 left the split to git subtree")
+		switches = [
+			*(["--annotate", options["annotate"]] if "annotate" in options else []),
+			*(["--ignore-joins"] if options.get("ignore_joins") else []),
+			*(["--onto", options["onto"]] if "onto" in options else []),
+		]
+		self.assertEqual(actual, git(self.project, "subtree", "split", "-q", "-P", prefix, *switches))
+
+	def test_split(self):
+		self.assertSameSplit("library")
+		self.assertSameSplit("deep/squashed")
+
+	def test_split_annotate(self):
+		self.assertSameSplit("library", annotate="(library) ")
+		self.assertSameSplit("deep/squashed", annotate="(squashed) ")
+
+	def test_split_ignore_joins(self):
+		self.assertSameSplit("library", ignore_joins=True)
+		self.assertSameSplit("library", annotate="(library) ", ignore_joins=True)
+
+	def test_split_onto(self):
+		self.assertSameSplit("library", onto=self.library_root)
+		self.assertSameSplit("deep/squashed", onto=self.library_root, ignore_joins=True)
+
+	def test_split_local_commit(self):
+		subtree = GitSubtree(self.project, prefix="library", quiet=True, backend="pygit2")
+		self.assertEqual(
+			subtree._pygit2_split("side"), git(self.project, "subtree", "split", "-q", "-P", "library", "side")
+		)
+
+
+if __name__ == "__main__":
+	unittest.main()